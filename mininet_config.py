@@ -41,7 +41,7 @@ topos = {'geant': GEANTopo}
 
 
 def launch(exec_id: str, mininet_bw: float, mininet_delay: str, server_queue: str, server_push: int, client_dash: str,
-           exec_duration: int, load: float, out_folder: str):
+           exec_duration: int, load: float, out_folder: str, congestion_control: str = "reno"):
     """
     Create and launch the network
     """
@@ -82,7 +82,8 @@ def launch(exec_id: str, mininet_bw: float, mininet_delay: str, server_queue: st
         push_flag = "-p"
 
     server_command = "python3 src/server.py -c cert/ssl_cert.pem -k cert/ssl_key.pem -q " + server_queue + " " \
-                     + push_flag + " > out/" + out_folder + "/" + exec_id + "-server_out.txt &"
+                     + push_flag + " --congestion-control " + congestion_control + " > out/" + out_folder + "/" \
+                     + exec_id + "-server_out.txt &"
     print(server_command)
     server.cmd(server_command)
     server_pid = get_last_pid(server)
@@ -272,9 +273,9 @@ if __name__ == '__main__':
         "-sq",
         "--server-queue",
         type=str,
-        choices=['WFQ', 'SP', 'FIFO'],
+        choices=['WFQ', 'SP', 'FIFO', 'EDF'],
         default="FIFO",
-        help="The queuing algorithm used by the Video Server (WFQ, FIFO or SP)"
+        help="The queuing algorithm used by the Video Server (WFQ, FIFO, SP or EDF)"
     )
     parser.add_argument(
         "-sp",
@@ -284,6 +285,14 @@ if __name__ == '__main__':
         default=1,
         help="If server push is enabled or not"
     )
+    parser.add_argument(
+        "-cc",
+        "--congestion-control",
+        type=str,
+        choices=['reno', 'bbr'],
+        default="reno",
+        help="The congestion control of the Video Server (reno or bbr)"
+    )
 
     # Client Parameters
     parser.add_argument(
@@ -325,4 +334,5 @@ if __name__ == '__main__':
 
     launch(exec_id=args.id, mininet_bw=args.mn_bandwidth, mininet_delay=args.mn_delay,
            server_queue=args.server_queue, server_push=args.server_push, client_dash=args.dash_algorithm,
-           exec_duration=args.exec_duration, load=args.load, out_folder=args.out_directory)
+           exec_duration=args.exec_duration, load=args.load, out_folder=args.out_directory,
+           congestion_control=args.congestion_control)
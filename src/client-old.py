@@ -1,7 +1,8 @@
 import argparse
 import asyncio
-import binascii
 import csv
+import dataclasses
+import logging
 import struct
 import datetime
 import timeit
@@ -9,16 +10,35 @@ import timeit
 from aioquic.asyncio import QuicConnectionProtocol
 from aioquic.asyncio.client import connect
 from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import DatagramFrameReceived
 from src.dash import Dash
 
-from src.structures.data_types import VideoPacket, QUICPacket
-from src.utils import message_to_video_packet, get_client_file_name, get_user_id, create_user_dir, host_parser
+from src.structures.data_types import VideoPacket, QUICPacket, SegmentRequest, DATAGRAM_TILE, serialize_hello
+from src.structures.tile_reassembler import TileReassembler
+from src.structures.session_tickets import SessionTicketCache
+from src.structures.event_logger import EventLogger, parse_sample_rates
+from src.structures.tile_storage import create_tile_storage
+from src.utils import decode_video_packet, get_user_id, host_parser
 from src.constants.video_constants import HIGH_PRIORITY, FRAME_TIME_MS, LOW_PRIORITY, VIDEO_FPS, CLIENT_BITRATES, \
-    N_SEGMENTS, MAX_TILE, INITIAL_BUFFER_SIZE
+    N_SEGMENTS, MAX_TILE, INITIAL_BUFFER_SIZE, BINARY_WIRE, LEGACY_WIRE, DATAGRAM_TIMEOUT, MEMORY_STORAGE, \
+    ARENA_STORAGE, FILES_STORAGE, ARENA_SIZE, STORAGE_WORKERS
 
 last_segment = 1
-Client_Log = False
+Event_Log = None
+Wire_Format = BINARY_WIRE
 received_files = [[False for x in range(N_SEGMENTS)] for y in range(MAX_TILE)]
+lost_files = set()  # (segment, tile) sent in datagrams that never completed
+requested_bitrates = {}  # (segment, tile) -> lowest bitrate it was requested at
+downgraded_tiles = 0  # Tiles the server sent below the requested bitrate
+Tile_Reassembler = None
+Datagram_Queue = None
+Ticket_Cache = None
+Early_Data = False
+Video = None
+Storage_Mode = MEMORY_STORAGE
+Arena_Size = ARENA_SIZE
+Storage_Workers = STORAGE_WORKERS
+Tile_Storage = None
 waiting_for_buffer = True
 downloaded_time = 0
 # 1: Sequencial, 2: Alternado
@@ -27,20 +47,116 @@ REQUEST_MODE = 1
 FOV_RATIO = 2
 
 
+class DatagramClientProtocol(QuicConnectionProtocol):
+    # Hands the DATAGRAM frames to receive_datagrams(), the other events go to the stream readers
+    def quic_event_received(self, event):
+        if isinstance(event, DatagramFrameReceived):
+            if Datagram_Queue is not None:
+                Datagram_Queue.put_nowait(event.data)
+        else:
+            super().quic_event_received(event)
+
+
 async def aioquic_client(ca_cert: str, connection_host: str, connection_port: int, dash_algorithm: Dash):
     print("Connecting to Host", connection_host, connection_port)
     configuration = QuicConfiguration(is_client=True)
+    if Tile_Reassembler is not None:
+        configuration.max_datagram_frame_size = 65536
     configuration.load_verify_locations(ca_cert)
-    async with connect(connection_host, connection_port, configuration=configuration) as client:
+
+    server = str(connection_host) + ":" + str(connection_port)
+    session_ticket_handler = None
+    if Ticket_Cache is not None:
+        configuration.session_ticket = Ticket_Cache.get(server)
+        if configuration.session_ticket is not None and not Early_Data:
+            # Resumption only, the ClientHello does not offer early data
+            configuration.session_ticket = dataclasses.replace(configuration.session_ticket, max_early_data_size=None)
+        session_ticket_handler = lambda ticket: Ticket_Cache.put(server, ticket)
+
+    start_time = timeit.default_timer()
+
+    # Without waiting for the handshake, the first requests go out as 0-RTT early data when a ticket is available
+    async with connect(connection_host, connection_port, configuration=configuration,
+                       create_protocol=DatagramClientProtocol, session_ticket_handler=session_ticket_handler,
+                       wait_connected=not Early_Data) as client:
         connection_protocol = QuicConnectionProtocol
         high_priority_reader, high_priority_writer = await connection_protocol.create_stream(client)
         low_priority_reader, low_priority_writer = await connection_protocol.create_stream(client)
+        asyncio.ensure_future(print_handshake(client, start_time))
         await handle_stream(high_priority_reader, high_priority_writer, low_priority_reader, low_priority_writer,
                             dash_algorithm)
 
 
+async def print_handshake(client, start_time):
+    await client.wait_connected()
+    tls = client._quic.tls
+    print("Handshake: " + str(round(timeit.default_timer() - start_time, 3)) + "s, session resumed: " +
+          str(tls.session_resumed) + ", 0-RTT accepted: " + str(tls.early_data_accepted))
+
+
 async def send_data(writer, stream_id, end_stream, packet=None, push_status=None):
-    data = QUICPacket(stream_id, end_stream, packet, push_status).serialize()
+    data = QUICPacket(stream_id, end_stream, packet, push_status).serialize(Wire_Format)
+
+    writer.write(struct.pack('<L', len(data)))
+    writer.write(data)
+
+    await asyncio.sleep(0.0001)
+
+
+async def send_hello(writer, client_id):
+    # Only on the first stream, the server takes the client and video of the other streams from it
+    data = serialize_hello(client_id, Video)
+
+    writer.write(struct.pack('<L', len(data)))
+    writer.write(data)
+
+
+async def send_segment_request(hp_writer, lp_writer, stream_id, segment, bitrate, tiles, fov_tiles):
+    # One message for the FOV tiles of the segment on the hp stream, and one for the others on the lp stream. The legacy
+    # wire format has no segment requests, so it falls back to one request per tile
+    # A tile requested again keeps its lowest bitrate, the answer to the earlier request may still be on its way
+    for tile in tiles:
+        requested_bitrates[(segment, tile)] = min(requested_bitrates.get((segment, tile), bitrate), bitrate)
+
+    if Wire_Format == LEGACY_WIRE:
+        for tile in tiles:
+            if tile in fov_tiles:
+                priority = HIGH_PRIORITY
+                writer_to_send = hp_writer
+            else:
+                priority = LOW_PRIORITY
+                writer_to_send = lp_writer
+
+            message = VideoPacket(segment, tile, priority, bitrate)
+            await send_data(writer_to_send, stream_id=stream_id, end_stream=False, packet=message)
+        return
+
+    fov_tiles = set(fov_tiles)
+    hp_tiles = [tile for tile in tiles if tile in fov_tiles]
+    lp_tiles = [tile for tile in tiles if tile not in fov_tiles]
+
+    for writer, writer_tiles, writer_fov_tiles in ((hp_writer, hp_tiles, hp_tiles), (lp_writer, lp_tiles, ())):
+        if not writer_tiles:
+            continue
+
+        request = SegmentRequest(segment, bitrate, writer_tiles, writer_fov_tiles)
+        data = QUICPacket(stream_id, False, segment_request=request).serialize(Wire_Format)
+
+        writer.write(struct.pack('<L', len(data)))
+        writer.write(data)
+
+    await asyncio.sleep(0.0001)
+
+
+async def send_cancel(writer, stream_id, segment, tiles):
+    # Removes the tiles still queued on the server, e.g. the missing tiles of a segment that was already played. The
+    # streams of the connection share the server queue, so it goes on one of them. Only the binary wire format has
+    # cancel messages
+    if Wire_Format == LEGACY_WIRE or not tiles:
+        return
+
+    request = SegmentRequest(segment, 0, tiles)
+    data = QUICPacket(stream_id, False, segment_request=request, cancel=True).serialize(Wire_Format)
 
     writer.write(struct.pack('<L', len(data)))
     writer.write(data)
@@ -50,18 +166,21 @@ async def send_data(writer, stream_id, end_stream, packet=None, push_status=None
 
 async def handle_stream(hp_reader, hp_writer, lp_reader, lp_writer, dash):
     global waiting_for_buffer
+    global Tile_Storage
 
     client_id = get_user_id()
     print("Starting Client: ", client_id)
-    create_user_dir(client_id)
+    Tile_Storage = create_tile_storage(Storage_Mode, client_id, Arena_Size, Storage_Workers)
+
+    if Tile_Reassembler is not None:
+        asyncio.ensure_future(receive_datagrams(dash))
 
     # User input
-    asyncio.ensure_future(receive(hp_reader, client_id, dash))
-    asyncio.ensure_future(receive(lp_reader, client_id, dash))
+    asyncio.ensure_future(receive(hp_reader, dash))
+    asyncio.ensure_future(receive(lp_reader, dash))
 
     # Server data received
-    hp_writer.write(client_id.encode())
-    await asyncio.sleep(0.0001)
+    await send_hello(hp_writer, client_id)
 
     # List all tiles
     tiles_list = list(range(1, MAX_TILE))
@@ -85,20 +204,17 @@ async def handle_stream(hp_reader, hp_writer, lp_reader, lp_writer, dash):
     # Initial buffer
     print("Initial Buffer...")
     for buffer_segment in range(1, INITIAL_BUFFER_SIZE+1):
-        if Client_Log:
-            print("Request segment ", buffer_segment)
+        Event_Log.debug("segment_requested", segment=buffer_segment)
 
         current_bitrate = dash.get_max_bitrate()
-        for tile in range(1, MAX_TILE):
-            message = VideoPacket(buffer_segment, tile,
-                                  HIGH_PRIORITY, current_bitrate)
-
-            await send_data(hp_writer, stream_id=client_id, end_stream=False, packet=message)
+        buffer_tiles = list(range(1, MAX_TILE))
+        await send_segment_request(hp_writer, hp_writer, client_id, buffer_segment, current_bitrate, buffer_tiles,
+                                   buffer_tiles)
 
         for tile in range(1, MAX_TILE):
             tile_exists = False
             while not tile_exists:
-                tile_exists = received_files[tile-1][buffer_segment-1]
+                tile_exists = received_files[tile-1][buffer_segment-1] or (buffer_segment, tile) in lost_files
                 await asyncio.sleep(0.01)
 
     print("Initial buffer complete.")
@@ -140,20 +256,16 @@ async def handle_stream(hp_reader, hp_writer, lp_reader, lp_writer, dash):
 
                 all_tiles = list(range(1, MAX_TILE))
 
+                # The previous segment is no longer played, its missing tiles would only waste the link
+                if video_segment > 1:
+                    late_tiles = [tile for tile in all_tiles if not received_files[tile-1][video_segment-2]]
+                    await send_cancel(hp_writer, client_id, video_segment - 1, late_tiles)
+
                 if REQUEST_MODE == 1:
                     # Request Ordenado
-                    for tile in all_tiles:
-                        if not received_files[tile-1][video_segment-1]:
-                            if tile in fov:
-                                priority = HIGH_PRIORITY
-                                writer_to_send = hp_writer
-                            else:
-                                priority = LOW_PRIORITY
-                                writer_to_send = lp_writer
-
-                            message = VideoPacket(
-                                video_segment, tile, priority, current_bitrate)
-                            await send_data(writer_to_send, stream_id=client_id, end_stream=False, packet=message)
+                    missing_tiles = [tile for tile in all_tiles if not received_files[tile-1][video_segment-1]]
+                    await send_segment_request(hp_writer, lp_writer, client_id, video_segment, current_bitrate,
+                                               missing_tiles, fov)
                 else:
                     # Request alternado
                     out_fov = list(set(all_tiles) - set(fov))
@@ -282,6 +394,13 @@ async def handle_stream(hp_reader, hp_writer, lp_reader, lp_writer, dash):
                     print("Bitrate médio: " +
                           str(round(sum_bitrate / N_SEGMENTS, 2)))
                     print("Bitrate por segmento: "+str(dash.bitrates_seg))
+                    print("Tiles recebidos com bitrate reduzido pelo servidor: " + str(downgraded_tiles))
+                    if Tile_Reassembler is not None:
+                        print("Tiles perdidos em datagramas: " + str(Tile_Reassembler.tiles_lost) + " de " +
+                              str(Tile_Reassembler.tiles_lost + Tile_Reassembler.tiles_completed))
+                    print("Armazenamento dos tiles (" + Tile_Storage.mode + "): " + str(Tile_Storage.tiles) +
+                          " tiles, " + str(round(Tile_Storage.bytes / 1000000, 2)) + " MB")
+                    Tile_Storage.close()
                     await send_data(hp_writer, stream_id=client_id, end_stream=True)
                     await send_data(lp_writer, stream_id=client_id, end_stream=True)
                     return
@@ -289,50 +408,90 @@ async def handle_stream(hp_reader, hp_writer, lp_reader, lp_writer, dash):
             frame += 1
 
 
-async def receive(reader, client_id, client_dash):
-    global last_segment
-    global Client_Log
-    global received_files
-    global downloaded_time
-
-    current_segment = 0
-
+async def receive(reader, client_dash):
     while True:
         start_time = timeit.default_timer()
 
-        size, = struct.unpack('<L', await reader.readexactly(4))
+        try:
+            size, = struct.unpack('<L', await reader.readexactly(4))
 
-        client_dash.append_download_size(size)
+            client_dash.append_download_size(size)
 
-        file_name_data = await reader.readexactly(size)
-        file_info = message_to_video_packet(eval(file_name_data.decode()))
+            file_name_data = await reader.readexactly(size)
+            file_info = decode_video_packet(file_name_data)
 
-        file_name = get_client_file_name(segment=file_info.segment, tile=file_info.tile, bitrate=file_info.bitrate,
-                                         client_id=client_id)
+            file_size, = struct.unpack('<L', await reader.readexactly(4))
+            if file_size == DATAGRAM_TILE:
+                # The tile itself comes in DATAGRAM frames, see receive_datagrams()
+                sequence, = struct.unpack('<L', await reader.readexactly(4))
+                Tile_Reassembler.expect(sequence, file_info, timeit.default_timer())
+                continue
 
-        with open(file_name, "wb") as newFile:
-            not_finished = True
-            while not_finished:
+            chunks = []
+            while file_size != 0:
+                chunks.append(await reader.readexactly(file_size))
                 file_size, = struct.unpack('<L', await reader.readexactly(4))
-                if file_size == 0:
-                    not_finished = False
-                else:
-                    chunk = await reader.readexactly(file_size)
-                    newFile.write(binascii.hexlify(chunk))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The server ended the stream, or the connection is gone
+            return
+
+        Tile_Storage.write(file_info.segment, file_info.tile, file_info.bitrate, chunks)
 
-        last_segment = file_info.segment
+        tile_received(file_info, timeit.default_timer() - start_time, client_dash)
 
-        received_files[file_info.tile-1][file_info.segment-1] = True
 
-        downloaded_time += 1/200
+async def receive_datagrams(client_dash):
+    # Reassembles the tiles sent in DATAGRAM frames. Tiles that time out are counted as missing, without new requests
+    while True:
+        try:
+            datagram = await asyncio.wait_for(Datagram_Queue.get(), timeout=0.1)
+            tile = Tile_Reassembler.add(datagram, timeit.default_timer())
+        except asyncio.TimeoutError:
+            tile = None
 
-        if Client_Log and current_segment != last_segment:
-            print("Receiving segment:", current_segment)
-        elif Client_Log:
-            print("Receiving file:", file_name)
+        if tile is not None:
+            file_info, data, download_time = tile
+            Tile_Storage.write(file_info.segment, file_info.tile, file_info.bitrate, [data])
+
+            tile_received(file_info, download_time, client_dash)
+
+        for file_info in Tile_Reassembler.expire(timeit.default_timer()):
+            tile_lost(file_info)
+
+
+def tile_received(file_info, download_time, client_dash):
+    global last_segment
+    global downloaded_time
+    global downgraded_tiles
 
-        client_dash.update_download_time(
-            timeit.default_timer() - start_time, int(file_info.segment))
+    last_segment = file_info.segment
+
+    received_files[file_info.tile-1][file_info.segment-1] = True
+
+    downloaded_time += 1/200
+
+    if Event_Log.is_enabled(logging.DEBUG):
+        Event_Log.debug("tile_received", segment=file_info.segment, tile=file_info.tile, bitrate=file_info.bitrate)
+
+    # The header has the bitrate actually sent, lower than the requested one when the server was backlogged
+    requested_bitrate = requested_bitrates.get((file_info.segment, file_info.tile), file_info.bitrate)
+    if int(file_info.bitrate) < int(requested_bitrate):
+        downgraded_tiles += 1
+        Event_Log.debug("tile_downgraded", segment=file_info.segment, tile=file_info.tile,
+                        requested_bitrate=requested_bitrate, bitrate=file_info.bitrate)
+
+    client_dash.update_download_time(download_time, int(file_info.segment))
+
+
+def tile_lost(file_info):
+    # A lost tile still takes its place in the downloaded time, so playback does not wait for it
+    global downloaded_time
+
+    lost_files.add((file_info.segment, file_info.tile))
+
+    downloaded_time += 1/200
+
+    Event_Log.info("tile_lost", segment=file_info.segment, tile=file_info.tile, bitrate=file_info.bitrate)
 
 
 async def play(play_dash, hp_writer, client_id):
@@ -364,20 +523,17 @@ async def fill_buffer(current_segment, buffer_dash, hp_writer, client_id):
           str(start_segment)+" to segment "+str(end_segment))
 
     for buffer_segment in range(start_segment, end_segment):
-        if Client_Log:
-            print("Request segment ", buffer_segment)
+        Event_Log.debug("segment_requested", segment=buffer_segment)
 
         current_bitrate = buffer_dash.get_max_bitrate()
-        for tile in range(1, MAX_TILE):
-            message = VideoPacket(buffer_segment, tile,
-                                  HIGH_PRIORITY, current_bitrate)
-
-            await send_data(hp_writer, stream_id=client_id, end_stream=False, packet=message)
+        buffer_tiles = list(range(1, MAX_TILE))
+        await send_segment_request(hp_writer, hp_writer, client_id, buffer_segment, current_bitrate, buffer_tiles,
+                                   buffer_tiles)
 
         for tile in range(1, MAX_TILE):
             tile_exists = False
             while not tile_exists:
-                tile_exists = received_files[tile-1][buffer_segment-1]
+                tile_exists = received_files[tile-1][buffer_segment-1] or (buffer_segment, tile) in lost_files
                 await asyncio.sleep(0.01)
     return
 
@@ -418,9 +574,111 @@ if __name__ == "__main__":
         help="dash algorithm (options: basic, basic2) - (defaults to basic)",
     )
 
+    parser.add_argument(
+        "-w",
+        "--wire-format",
+        required=False,
+        default=BINARY_WIRE,
+        choices=[BINARY_WIRE, LEGACY_WIRE],
+        type=str,
+        help="encoding of the requests, use legacy with older servers (defaults to binary)",
+    )
+
+    parser.add_argument(
+        "--event-log",
+        type=str,
+        help="file the JSON lines events are appended to (defaults to the standard error, so the standard output "
+             "only has the summaries)",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        choices=["DEBUG", "INFO", "WARNING"],
+        default="INFO",
+        help="lowest level of the logged events, -v sets DEBUG (defaults to INFO)",
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=str,
+        default="",
+        help="comma separated event=N pairs, logging one of every N of those events (e.g. tile_received=100)",
+    )
+
+    parser.add_argument(
+        "--session-tickets",
+        type=str,
+        help="file that keeps the session tickets of the servers, to resume the next sessions",
+    )
+    parser.add_argument(
+        "--early-data",
+        help="send the first requests as 0-RTT early data when a session ticket is available",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--datagrams",
+        help="accept tiles in QUIC DATAGRAM frames, if the server sends them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--datagram-timeout",
+        type=float,
+        default=DATAGRAM_TIMEOUT,
+        help="seconds before an incomplete datagram tile is counted as lost (defaults to 1)",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=[MEMORY_STORAGE, ARENA_STORAGE, FILES_STORAGE],
+        default=MEMORY_STORAGE,
+        help="what is done with the received tiles: only counted (memory), copied into one preallocated file per "
+             "session (arena) or written to a file each by a thread pool (files) (defaults to memory)",
+    )
+    parser.add_argument(
+        "--arena-size",
+        type=float,
+        default=ARENA_SIZE,
+        help="initial size of the arena file in MB, it doubles when full (defaults to " + str(ARENA_SIZE) + ")",
+    )
+    parser.add_argument(
+        "--storage-workers",
+        type=int,
+        default=STORAGE_WORKERS,
+        help="threads writing the tile files of --storage files (defaults to " + str(STORAGE_WORKERS) + ")",
+    )
+
+    parser.add_argument(
+        "--video",
+        type=str,
+        help="id of the video to stream, for servers with several videos (defaults to the server's first video)",
+    )
+
     args = parser.parse_args()
 
-    Client_Log = args.verbose
+    try:
+        Event_Log = EventLogger(args.event_log, logging.DEBUG if args.verbose else getattr(logging, args.log_level),
+                                parse_sample_rates(args.log_sample))
+    except ValueError as err:
+        parser.error(str(err))
+
+    Wire_Format = args.wire_format
+
+    if args.early_data and not args.session_tickets:
+        parser.error("--early-data requires --session-tickets")
+
+    if args.session_tickets:
+        Ticket_Cache = SessionTicketCache(args.session_tickets)
+    Early_Data = args.early_data
+    Video = args.video
+
+    if args.arena_size <= 0 or args.storage_workers < 1:
+        parser.error("--arena-size and --storage-workers must be positive")
+    Storage_Mode = args.storage
+    Arena_Size = args.arena_size
+    Storage_Workers = args.storage_workers
+
+    if args.datagrams:
+        Tile_Reassembler = TileReassembler(args.datagram_timeout)
+        Datagram_Queue = asyncio.Queue()
 
     User_Input_File = args.user_input
 
@@ -433,3 +691,4 @@ if __name__ == "__main__":
 
     asyncio.get_event_loop().run_until_complete(aioquic_client(ca_cert=args.ca_certs, connection_host=host,
                                                                connection_port=port, dash_algorithm=user_dash))
+    Event_Log.close()
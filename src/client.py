@@ -1,130 +1,409 @@
 import argparse
 import asyncio
-import binascii
-import csv
-import string
+import dataclasses
+import logging
 import struct
-import datetime
 import timeit
-from typing import List, Tuple
-from dataclasses import dataclass
 
+import numpy as np
 from aioquic.asyncio import QuicConnectionProtocol
 from aioquic.asyncio.client import connect as conn
 from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import DatagramFrameReceived
 from src.dash import Dash
 
-from src.structures.data_types import VideoPacket, QUICPacket
-from src.utils import message_to_video_packet, get_client_file_name, get_user_id, create_user_dir, host_parser
+from src.structures.data_types import VideoPacket, QUICPacket, SegmentRequest, DATAGRAM_TILE, serialize_hello
+from src.structures.tile_reassembler import TileReassembler
+from src.structures.session_tickets import SessionTicketCache
+from src.structures.event_logger import EventLogger, parse_sample_rates
+from src.structures.playback_buffer import PlaybackBuffer
+from src.structures.tile_storage import create_tile_storage
+from src.structures.viewport_trace import load_trace
+from src.utils import decode_video_packet, get_user_id, host_parser
 from src.constants.video_constants import HIGH_PRIORITY, FRAME_TIME_MS, LOW_PRIORITY, VIDEO_FPS, CLIENT_BITRATES, \
-    N_SEGMENTS, MAX_TILE, INITIAL_BUFFER_SIZE
+    N_SEGMENTS, INITIAL_BUFFER_SIZE, SEGMENT_DURATION, BINARY_WIRE, LEGACY_WIRE, MEMORY_STORAGE, ARENA_STORAGE, \
+    FILES_STORAGE, ARENA_SIZE, STORAGE_WORKERS, DATAGRAM_TIMEOUT
+
+Wire_Format = BINARY_WIRE
+Event_Log = None
+Tile_Reassembler = None
+Datagram_Queue = None
+Ticket_Cache = None
+Early_Data = False
+Video = None
+Storage_Mode = MEMORY_STORAGE
+Arena_Size = ARENA_SIZE
+Storage_Workers = STORAGE_WORKERS
+Tile_Storage = None
+rebuffer_count = 0  # Times the playback stopped to fill the buffer
+rebuffer_time = 0.0  # Seconds the playback was stopped
+
+
+class DatagramClientProtocol(QuicConnectionProtocol):
+    # Hands the DATAGRAM frames to receive_datagrams(), the other events go to the stream readers
+    def quic_event_received(self, event):
+        if isinstance(event, DatagramFrameReceived):
+            if Datagram_Queue is not None:
+                Datagram_Queue.put_nowait(event.data)
+        else:
+            super().quic_event_received(event)
 
 
-@dataclass
-class Tile:
-    file_name: str
-    file_data: VideoPacket
+async def send_data(writer, stream_id, end_stream, packet=None, push_status=None):
+    data = QUICPacket(stream_id, end_stream, packet, push_status).serialize(Wire_Format)
 
+    writer.write(struct.pack('<L', len(data)))
+    writer.write(data)
 
-@dataclass
-class Segment:
-    index: int
-    tiles: List[Tile]
 
+async def send_hello(writer, client_id):
+    # Only on the first stream, the server takes the client and video of the other streams from it
+    data = serialize_hello(client_id, Video)
 
-SEGMENT_DURATION = 1  # in seconds
-buffer: List[Segment] = []
-buffer_limit = 10  # in number of segments
-buffer_offset = 0  # in number of segments
+    writer.write(struct.pack('<L', len(data)))
+    writer.write(data)
 
 
-async def send_data(writer, stream_id, end_stream, packet=None, push_status=None):
-    data = QUICPacket(stream_id, end_stream, packet, push_status).serialize()
+async def send_segment_request(hp_writer, lp_writer, stream_id, segment, bitrate, tiles, fov_tiles):
+    # One message for the FOV tiles of the segment on the hp stream, and one for the others on the lp stream. The legacy
+    # wire format has no segment requests, so it falls back to one request per tile
+    if Wire_Format == LEGACY_WIRE:
+        for tile in tiles:
+            if tile in fov_tiles:
+                await send_data(hp_writer, stream_id, False, VideoPacket(segment, tile, HIGH_PRIORITY, bitrate))
+            else:
+                await send_data(lp_writer, stream_id, False, VideoPacket(segment, tile, LOW_PRIORITY, bitrate))
+        return
+
+    fov_tiles = set(fov_tiles)
+    hp_tiles = [tile for tile in tiles if tile in fov_tiles]
+    lp_tiles = [tile for tile in tiles if tile not in fov_tiles]
+
+    for writer, writer_tiles, writer_fov_tiles in ((hp_writer, hp_tiles, hp_tiles), (lp_writer, lp_tiles, ())):
+        if not writer_tiles:
+            continue
+
+        data = QUICPacket(stream_id, False,
+                          segment_request=SegmentRequest(segment, bitrate, writer_tiles, writer_fov_tiles)) \
+            .serialize(Wire_Format)
+
+        writer.write(struct.pack('<L', len(data)))
+        writer.write(data)
+
+
+async def send_cancel(writer, stream_id, segment, tiles):
+    # Removes the tiles still queued on the server, e.g. the missing tiles of a segment that was already played. The
+    # streams of the connection share the server queue, so it goes on one of them. Only the binary wire format has
+    # cancel messages
+    if Wire_Format == LEGACY_WIRE or not tiles:
+        return
+
+    data = QUICPacket(stream_id, False, segment_request=SegmentRequest(segment, 0, tiles), cancel=True) \
+        .serialize(Wire_Format)
 
     writer.write(struct.pack('<L', len(data)))
     writer.write(data)
 
 
-async def connect(ca_cert: str, connection_host: str, connection_port: int):
+async def client(ca_cert: str, connection_host: str, connection_port: int, dash_algorithm: Dash):
     print("Connecting to Host", connection_host, connection_port)
     configuration = QuicConfiguration(is_client=True)
+    if Tile_Reassembler is not None:
+        configuration.max_datagram_frame_size = 65536
     configuration.load_verify_locations(ca_cert)
-    async with conn(connection_host, connection_port, configuration=configuration) as client:
-        connection_protocol = QuicConnectionProtocol
-        high_priority_reader, high_priority_writer = await connection_protocol.create_stream(client)
-        low_priority_reader, low_priority_writer = await connection_protocol.create_stream(client)
-        return high_priority_reader, high_priority_writer, low_priority_reader, low_priority_writer
 
+    server = str(connection_host) + ":" + str(connection_port)
+    session_ticket_handler = None
+    if Ticket_Cache is not None:
+        configuration.session_ticket = Ticket_Cache.get(server)
+        if configuration.session_ticket is not None and not Early_Data:
+            # Resumption only, the ClientHello does not offer early data
+            configuration.session_ticket = dataclasses.replace(configuration.session_ticket, max_early_data_size=None)
+        session_ticket_handler = lambda ticket: Ticket_Cache.put(server, ticket)
 
-async def client(ca_cert: str, connection_host: str, connection_port: int, dash_algorithm: Dash):
-    hp_reader, hp_writer, lp_reader, lp_writer = await connect(
-        ca_cert=ca_cert, connection_host=connection_host, connection_port=connection_port)  # initialize connection
+    start_time = timeit.default_timer()
+
+    # Without waiting for the handshake, the first requests go out as 0-RTT early data when a ticket is available
+    async with conn(connection_host, connection_port, configuration=configuration,
+                    create_protocol=DatagramClientProtocol, session_ticket_handler=session_ticket_handler,
+                    wait_connected=not Early_Data) as connection:
+        high_priority_reader, high_priority_writer = await connection.create_stream()
+        low_priority_reader, low_priority_writer = await connection.create_stream()
+        asyncio.ensure_future(print_handshake(connection, start_time))
+        await handle_stream(high_priority_reader, high_priority_writer, low_priority_reader, low_priority_writer,
+                            dash_algorithm)
+
+
+async def print_handshake(connection, start_time):
+    await connection.wait_connected()
+    tls = connection._quic.tls
+    print("Handshake: " + str(round(timeit.default_timer() - start_time, 3)) + "s, session resumed: " +
+          str(tls.session_resumed) + ", 0-RTT accepted: " + str(tls.early_data_accepted))
+
+
+async def handle_stream(hp_reader, hp_writer, lp_reader, lp_writer, dash):
+    global Tile_Storage
 
     client_id = get_user_id()
     print("Starting Client: ", client_id)
-    create_user_dir(client_id)
+    Tile_Storage = create_tile_storage(Storage_Mode, client_id, Arena_Size, Storage_Workers)
+
+    playback_buffer = PlaybackBuffer()
+    playing = asyncio.Event()
+
+    if Tile_Reassembler is not None:
+        asyncio.ensure_future(receive_datagrams(dash, playback_buffer))
 
     # thread para receber
-    asyncio.ensure_future(
-        receive(reader=hp_reader, client_id=client_id, dash=dash_algorithm))
-    asyncio.ensure_future(
-        receive(reader=lp_reader, client_id=client_id, dash=dash_algorithm))
-
-    hp_writer.write(client_id.encode())
-
-    # send data
-    message = VideoPacket(1, 1,
-                          HIGH_PRIORITY, 10)
-    await send_data(hp_writer, stream_id=client_id, end_stream=False, packet=message)
-    message = VideoPacket(1, 3,
-                          HIGH_PRIORITY, 10)
-    await send_data(hp_writer, stream_id=client_id, end_stream=False, packet=message)
-    message = VideoPacket(1, 5,
-                          HIGH_PRIORITY, 10)
-    await send_data(hp_writer, stream_id=client_id, end_stream=False, packet=message)
-    message = VideoPacket(1, 2,
-                          HIGH_PRIORITY, 10)
-    await send_data(hp_writer, stream_id=client_id, end_stream=False, packet=message)
-    message = VideoPacket(1, 4,
-                          HIGH_PRIORITY, 10)
-    await send_data(hp_writer, stream_id=client_id, end_stream=False, packet=message)
-
-    await asyncio.sleep(10)
-
-    await send_data(hp_writer, stream_id=client_id, end_stream=True)
-    await send_data(lp_writer, stream_id=client_id, end_stream=True)
-
-
-async def receive(reader: asyncio.StreamReader, client_id: str, dash: Dash):
-    try:
-        while True:
+    asyncio.ensure_future(receive(hp_reader, dash, playback_buffer))
+    asyncio.ensure_future(receive(lp_reader, dash, playback_buffer))
+
+    await send_hello(hp_writer, client_id)
+
+    # Missed and total tiles of every frame, added up by segment
+    missed_frames_seg = np.zeros(N_SEGMENTS + 1, dtype=np.int64)
+    total_frames_seg = np.zeros(N_SEGMENTS + 1, dtype=np.int64)
+    missed_frames_seg_fov = np.zeros(N_SEGMENTS + 1, dtype=np.int64)
+    total_frames_seg_fov = np.zeros(N_SEGMENTS + 1, dtype=np.int64)
+
+    # The missing ratio has always left out the first tile of every frame of the trace
+    fov_masks = User_Trace.fov_mask(skip_first=True)[:, playback_buffer.tiles]
+    fov_counts = np.count_nonzero(fov_masks, axis=1)
+
+    print("Initial Buffer...")
+    await fill_buffer(1, playback_buffer, dash, hp_writer, client_id)
+    print("Initial buffer complete.")
+    playing.set()
+
+    asyncio.ensure_future(play(playback_buffer, playing, dash, hp_writer, client_id))
+
+    loop = asyncio.get_event_loop()
+
+    video_segment = 0
+    frame_request = 1
+
+    for frame in range(1, User_Trace.n_frames + 1):
+        frame_time = loop.time()
+
+        # Frame to make request
+        if frame == frame_request and video_segment < N_SEGMENTS:
+            fov = User_Trace.fov(frame)
+
+            video_segment += 1
+
+            current_bitrate = dash.get_next_bitrate(video_segment)
+
+            if not playing.is_set():
+                print("Waiting for the buffer to fill...")
+                await playing.wait()
+
+            print("Client requesting segment: ", video_segment)
+
+            # The previous segment is no longer played, its missing tiles would only waste the link
+            if video_segment > 1:
+                await send_cancel(hp_writer, client_id, video_segment - 1, playback_buffer.missing(video_segment - 1))
+
+            playback_buffer.set_fov(video_segment, fov)
+            missing_tiles = playback_buffer.missing(video_segment)
+            playback_buffer.request(video_segment, current_bitrate, missing_tiles)
+            await send_segment_request(hp_writer, lp_writer, client_id, video_segment, current_bitrate, missing_tiles,
+                                       fov)
+
+            frame_request += VIDEO_FPS
+
+        # Wait for the actual time of the frame
+        await asyncio.sleep(max(frame_time + FRAME_TIME_MS / 1000000 - loop.time(), 0))
+
+        # CHECK FOR MISSING RATIO
+        missing = playback_buffer.missing_mask(video_segment)
+        missed_frames_seg[video_segment] += np.count_nonzero(missing)
+        total_frames_seg[video_segment] += len(missing)
+        missed_frames_seg_fov[video_segment] += np.count_nonzero(missing & fov_masks[frame])
+        total_frames_seg_fov[video_segment] += fov_counts[frame]
+
+        # On last segment, print the results and end connection
+        if frame == (N_SEGMENTS*VIDEO_FPS)+1:
+            print_results(dash, playback_buffer, missed_frames_seg, total_frames_seg, missed_frames_seg_fov,
+                          total_frames_seg_fov)
+            await send_data(hp_writer, stream_id=client_id, end_stream=True)
+            await send_data(lp_writer, stream_id=client_id, end_stream=True)
+            return
+
+
+def print_results(dash, playback_buffer, missed_frames_seg, total_frames_seg, missed_frames_seg_fov,
+                  total_frames_seg_fov):
+    missing_ratio = {}
+    missing_ratio_fov = {}
+    sum_bitrate = 0
+    download_time_seg = {}
+    for i in range(1, N_SEGMENTS + 1):
+        missing_ratio[i] = str(round((int(missed_frames_seg[i])/int(total_frames_seg[i]))*100, 2))+"%"
+        missing_ratio_fov[i] = str(round((int(missed_frames_seg_fov[i])/int(total_frames_seg_fov[i]))*100, 2))+'%'
+
+        sum_bitrate += dash.bitrates_seg[i]
+        segment_download_time = playback_buffer.segment_download_time(i)
+        if segment_download_time is not None:
+            download_time_seg[i] = str(round(segment_download_time, 2))+'s'
+        else:
+            download_time_seg[i] = 'NOT_FINISHED'
+
+    missing_ratio_total = round((int(missed_frames_seg.sum())/int(total_frames_seg.sum()))*100, 2)
+    missing_ratio_total_fov = round((int(missed_frames_seg_fov.sum())/int(total_frames_seg_fov.sum()))*100, 2)
+
+    print("Missing ratio total: "+str(missing_ratio_total)+"%")
+    print("Missing ratio total (campo visão): " +
+          str(missing_ratio_total_fov)+"%")
+    print("Missing ratio por segmento: "+str(missing_ratio))
+    print("Missing ratio por segmento (campo visão): " +
+          str(missing_ratio_fov))
+    print("Tempo total de download: " +
+          str(round(playback_buffer.total_download_time(), 2))+"s")
+    print("Tempo total de download por segmento: " +
+          str(download_time_seg))
+    print("Bitrate médio: " +
+          str(round(sum_bitrate / N_SEGMENTS, 2)))
+    print("Bitrate por segmento: "+str(dash.bitrates_seg))
+    print("Tiles recebidos com bitrate reduzido pelo servidor: " + str(playback_buffer.tiles_downgraded))
+    if Tile_Reassembler is not None:
+        print("Tiles perdidos em datagramas: " + str(Tile_Reassembler.tiles_lost) + " de " +
+              str(Tile_Reassembler.tiles_lost + Tile_Reassembler.tiles_completed))
+    print("Paradas para encher o buffer: " + str(rebuffer_count) + ", tempo total: " +
+          str(round(rebuffer_time, 2)) + "s")
+    print("Armazenamento dos tiles (" + Tile_Storage.mode + "): " + str(Tile_Storage.tiles) +
+          " tiles, " + str(round(Tile_Storage.bytes / 1000000, 2)) + " MB")
+    Tile_Storage.close()
+
+
+async def receive(reader, client_dash, playback_buffer):
+    while True:
+        start_time = timeit.default_timer()
+
+        try:
             size, = struct.unpack('<L', await reader.readexactly(4))
 
-            dash.append_download_size(size)
+            client_dash.append_download_size(size)
 
             file_name_data = await reader.readexactly(size)
-            file_data = message_to_video_packet(eval(file_name_data.decode()))
-            file_name = get_client_file_name(segment=file_data.segment, tile=file_data.tile, bitrate=file_data.bitrate,
-                                             client_id=client_id)
-
-            print(
-                f'Receiving segment {file_data.segment} tile {file_data.tile}')
-
-            # add to buffer
-            if len(buffer) + buffer_offset < file_data.segment:  # add new segment
-                tiles = MAX_TILE*[None]
-                tile = Tile(file_name=file_name, file_data=file_data)
-                tile_index = file_data.tile-1
-                tiles[tile_index] = tile
-                segment = Segment(index=file_data.segment, tiles=tiles)
-                buffer.append(segment)
-            else:  # append tile to existing segment
-                segment_index = file_data.segment-1-buffer_offset
-                tile_index = file_data.tile - 1
-                buffer[segment_index].tiles[tile_index] = Tile(
-                    file_name=file_name, file_data=file_data)
-    except Exception as err:
-        print(err)
+            file_info = decode_video_packet(file_name_data)
+
+            file_size, = struct.unpack('<L', await reader.readexactly(4))
+            if file_size == DATAGRAM_TILE:
+                # The tile itself comes in DATAGRAM frames, see receive_datagrams()
+                sequence, = struct.unpack('<L', await reader.readexactly(4))
+                Tile_Reassembler.expect(sequence, file_info, timeit.default_timer())
+                continue
+
+            chunks = []
+            while file_size != 0:
+                chunks.append(await reader.readexactly(file_size))
+                file_size, = struct.unpack('<L', await reader.readexactly(4))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The server ended the stream, or the connection is gone
+            return
+
+        Tile_Storage.write(file_info.segment, file_info.tile, file_info.bitrate, chunks)
+
+        tile_received(file_info, sum(len(chunk) for chunk in chunks), timeit.default_timer() - start_time,
+                      client_dash, playback_buffer)
+
+
+async def receive_datagrams(client_dash, playback_buffer):
+    # Reassembles the tiles sent in DATAGRAM frames. Tiles that time out are counted as missing, without new requests
+    while True:
+        try:
+            datagram = await asyncio.wait_for(Datagram_Queue.get(), timeout=0.1)
+            tile = Tile_Reassembler.add(datagram, timeit.default_timer())
+        except asyncio.TimeoutError:
+            tile = None
+
+        if tile is not None:
+            file_info, data, download_time = tile
+            Tile_Storage.write(file_info.segment, file_info.tile, file_info.bitrate, [data])
+
+            tile_received(file_info, len(data), download_time, client_dash, playback_buffer)
+
+        for file_info in Tile_Reassembler.expire(timeit.default_timer()):
+            tile_lost(file_info, playback_buffer)
+
+
+def tile_received(file_info, tile_size, download_time, client_dash, playback_buffer):
+    segment = int(file_info.segment)
+
+    # Resolves the segment's futures once its last tile is in. The header has the bitrate actually sent, lower than
+    # the requested one when the server was backlogged
+    downgraded_tiles = playback_buffer.tiles_downgraded
+    playback_buffer.add(segment, int(file_info.tile), int(file_info.bitrate), tile_size, download_time)
+
+    # Once per tile, the fields are only built when they are logged
+    if Event_Log.is_enabled(logging.DEBUG):
+        Event_Log.debug("tile_received", segment=file_info.segment, tile=file_info.tile, bitrate=file_info.bitrate)
+    if playback_buffer.tiles_downgraded > downgraded_tiles and Event_Log.is_enabled(logging.DEBUG):
+        Event_Log.debug("tile_downgraded", segment=file_info.segment, tile=file_info.tile,
+                        requested_bitrate=int(playback_buffer.requested_bitrate[segment, int(file_info.tile)]),
+                        bitrate=file_info.bitrate)
+
+    client_dash.update_download_time(download_time, int(file_info.segment))
+
+
+def tile_lost(file_info, playback_buffer):
+    # A lost tile still counts as in, so neither the player nor the buffering waits for it
+    playback_buffer.lose(int(file_info.segment), int(file_info.tile))
+
+    Event_Log.info("tile_lost", segment=file_info.segment, tile=file_info.tile, bitrate=file_info.bitrate)
+
+
+async def play(playback_buffer, playing, play_dash, hp_writer, client_id):
+    # Plays a segment every SEGMENT_DURATION, from the end of the initial buffer. A segment plays if the tiles of its
+    # FOV come in before the end of its slot. Otherwise playback stops, the buffer is filled again from that segment and
+    # playback resumes the moment it is full
+    global rebuffer_count
+    global rebuffer_time
+
+    loop = asyncio.get_event_loop()
+    play_time = loop.time()
+    for segment in range(1, playback_buffer.n_segments + 1):
+        await asyncio.sleep(max(play_time - loop.time(), 0))
+
+        played_time = (segment - 1) * SEGMENT_DURATION
+        print("Buffer: " + '{0:.2f}'.format(played_time) + "s/" +
+              '{0:.2f}'.format(played_time + playback_buffer.buffered_seconds(segment, SEGMENT_DURATION)) + "s")
+
+        try:
+            await asyncio.wait_for(asyncio.shield(playback_buffer.fov_complete(segment)),
+                                   max(play_time + SEGMENT_DURATION - loop.time(), 0))
+        except asyncio.TimeoutError:
+            # data_scrapper.py counts a rebuffer per line, of (end - start) seconds
+            print("Filling buffer from segment " + str(segment) + " to segment " +
+                  str(min(playback_buffer.n_segments, segment + INITIAL_BUFFER_SIZE)))
+
+            stop_time = loop.time()
+            playing.clear()
+            await fill_buffer(segment, playback_buffer, play_dash, hp_writer, client_id)
+            playing.set()
+
+            play_time = loop.time()
+            rebuffer_count += 1
+            rebuffer_time += play_time - stop_time
+            Event_Log.info("rebuffer", segment=segment, duration=round(play_time - stop_time, 3))
+
+        Event_Log.debug("segment_played", segment=segment)
+        play_time += SEGMENT_DURATION
+
+
+async def fill_buffer(start_segment, playback_buffer, buffer_dash, hp_writer, client_id):
+    # Requests INITIAL_BUFFER_SIZE segments from 'start_segment', all of their tiles at the highest bitrate, and waits
+    # for each one to complete before requesting the next
+    end_segment = min(playback_buffer.n_segments, start_segment + INITIAL_BUFFER_SIZE - 1)
+
+    for buffer_segment in range(start_segment, end_segment + 1):
+        Event_Log.debug("segment_requested", segment=buffer_segment)
+
+        current_bitrate = buffer_dash.get_max_bitrate()
+        playback_buffer.request(buffer_segment, current_bitrate, playback_buffer.tiles)
+        await send_segment_request(hp_writer, hp_writer, client_id, buffer_segment, current_bitrate,
+                                   playback_buffer.tiles, playback_buffer.tiles)
+
+        await playback_buffer.complete(buffer_segment)
 
 
 if __name__ == "__main__":
@@ -146,7 +425,12 @@ if __name__ == "__main__":
         "--user-input",
         required=True,
         type=str,
-        help="CSV file with user input simulation",
+        help="user input simulation, a CSV file or a trace file written by src/trace_converter.py",
+    )
+    parser.add_argument(
+        "--trace-user",
+        type=str,
+        help="user whose input is simulated, in a trace file with many users (defaults to the first one)",
     )
     parser.add_argument(
         "-v",
@@ -162,12 +446,114 @@ if __name__ == "__main__":
         type=str,
         help="dash algorithm (options: basic, basic2) - (defaults to basic)",
     )
+    parser.add_argument(
+        "-w",
+        "--wire-format",
+        required=False,
+        default=BINARY_WIRE,
+        choices=[BINARY_WIRE, LEGACY_WIRE],
+        type=str,
+        help="encoding of the requests, use legacy with older servers (defaults to binary)",
+    )
+
+    parser.add_argument(
+        "--event-log",
+        type=str,
+        help="file the JSON lines events are appended to (defaults to the standard error, so the standard output "
+             "only has the summaries)",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        choices=["DEBUG", "INFO", "WARNING"],
+        default="INFO",
+        help="lowest level of the logged events, -v sets DEBUG (defaults to INFO)",
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=str,
+        default="",
+        help="comma separated event=N pairs, logging one of every N of those events (e.g. tile_received=100)",
+    )
+    parser.add_argument(
+        "--video",
+        type=str,
+        help="id of the video to stream, for servers with several videos (defaults to the server's first video)",
+    )
+    parser.add_argument(
+        "--session-tickets",
+        type=str,
+        help="file that keeps the session tickets of the servers, to resume the next sessions",
+    )
+    parser.add_argument(
+        "--early-data",
+        help="send the first requests as 0-RTT early data when a session ticket is available",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--datagrams",
+        help="accept tiles in QUIC DATAGRAM frames, if the server sends them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--datagram-timeout",
+        type=float,
+        default=DATAGRAM_TIMEOUT,
+        help="seconds before an incomplete datagram tile is counted as lost (defaults to 1)",
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        choices=[MEMORY_STORAGE, ARENA_STORAGE, FILES_STORAGE],
+        default=MEMORY_STORAGE,
+        help="what is done with the received tiles: only counted (memory), copied into one preallocated file per "
+             "session (arena) or written to a file each by a thread pool (files) (defaults to memory)",
+    )
+    parser.add_argument(
+        "--arena-size",
+        type=float,
+        default=ARENA_SIZE,
+        help="initial size of the arena file in MB, it doubles when full (defaults to " + str(ARENA_SIZE) + ")",
+    )
+    parser.add_argument(
+        "--storage-workers",
+        type=int,
+        default=STORAGE_WORKERS,
+        help="threads writing the tile files of --storage files (defaults to " + str(STORAGE_WORKERS) + ")",
+    )
 
     args = parser.parse_args()
 
-    Client_Log = args.verbose
+    try:
+        Event_Log = EventLogger(args.event_log, logging.DEBUG if args.verbose else getattr(logging, args.log_level),
+                                parse_sample_rates(args.log_sample))
+    except ValueError as err:
+        parser.error(str(err))
+
+    Wire_Format = args.wire_format
+
+    if args.early_data and not args.session_tickets:
+        parser.error("--early-data requires --session-tickets")
+
+    if args.session_tickets:
+        Ticket_Cache = SessionTicketCache(args.session_tickets)
+    Early_Data = args.early_data
+    Video = args.video
 
-    User_Input_File = args.user_input
+    if args.arena_size <= 0 or args.storage_workers < 1:
+        parser.error("--arena-size and --storage-workers must be positive")
+    Storage_Mode = args.storage
+    Arena_Size = args.arena_size
+    Storage_Workers = args.storage_workers
+
+    if args.datagrams:
+        Tile_Reassembler = TileReassembler(args.datagram_timeout)
+        Datagram_Queue = asyncio.Queue()
+
+    try:
+        User_Trace = load_trace(args.user_input, args.trace_user)
+    except (ValueError, OSError) as err:
+        parser.error(str(err))
 
     host, port = host_parser(args.url)
 
@@ -178,3 +564,4 @@ if __name__ == "__main__":
 
     asyncio.get_event_loop().run_until_complete(client(ca_cert=args.ca_certs,
                                                        connection_host=host, connection_port=port, dash_algorithm=user_dash))
+    Event_Log.close()
@@ -13,8 +13,10 @@ MAX_TILE = 200
 VIDEO_FPS = 30
 FRAME_TIME_MS = 33333
 N_SEGMENTS = 50
+SEGMENT_DURATION = 1  # in seconds
 CLIENT_BITRATES = [3, 7, 10]
 INITIAL_BUFFER_SIZE = 2
+DEFAULT_VIDEO = 'default'  # Id of the video above, served when no manifest is loaded
 
 # Priorities
 HIGHEST_PRIORITY = 0
@@ -25,6 +27,7 @@ LOW_PRIORITY = 2
 TILE_REQUEST = 'tile'
 PUSH_REQUEST = 'push'
 CLOSE_REQUEST = 'close'
+CANCEL_REQUEST = 'cancel'
 
 # Push status
 PUSH_CANCEL = 'push_cancel'
@@ -35,3 +38,40 @@ PUSH_PROMISE = 'push_promise'
 WFQ_QUEUE = 'WFQ'
 SP_QUEUE = 'SP'
 FIFO_QUEUE = 'FIFO'
+EDF_QUEUE = 'EDF'
+
+# WFQ
+WFQ_WEIGHTS = [0.75, 0.25]  # Share of the bandwidth of each priority class (FOV, out of FOV)
+WFQ_TILE_SIZE = 'tile'
+WFQ_REQUEST_SIZE = 'request'
+
+# Tile cache
+LRU_POLICY = 'LRU'
+LFU_POLICY = 'LFU'
+
+# Wire format
+BINARY_WIRE = 'binary'
+LEGACY_WIRE = 'legacy'
+WIRE_VERSION = 1
+HELLO_TIMEOUT = 10  # seconds a stream waits for the hello of its connection, sent on another stream
+
+# Datagram delivery
+DATAGRAM_OFF = 'off'
+DATAGRAM_LOW = 'low'  # Only LOW_PRIORITY tiles
+DATAGRAM_ALL = 'all'
+DATAGRAM_PAYLOAD_SIZE = 1100  # bytes of each DATAGRAM frame, header included, so that it fits in one QUIC packet
+DATAGRAM_TIMEOUT = 1  # seconds a tile can stay incomplete before it is counted as lost
+
+# Congestion control
+RENO_CONTROL = 'reno'  # aioquic's NewReno
+BBR_CONTROL = 'bbr'
+
+# Client tile storage
+MEMORY_STORAGE = 'memory'  # Tiles are only counted, then dropped
+ARENA_STORAGE = 'arena'  # One preallocated file per session
+FILES_STORAGE = 'files'  # One file per tile, written from a thread pool
+ARENA_SIZE = 256  # in MB, initial size of the arena file
+STORAGE_WORKERS = 4
+
+# Metrics
+METRICS_LOOP_INTERVAL = 0.1  # seconds between the event loop lag checks
@@ -102,7 +102,8 @@ class Dash():
         elif self.current_bitrate < bitrates[-1]:
             if sigma_download >= bitrates[curr - 1]/bitrates[curr]:
                 temp_index = curr
-                while next_rate < bitrates[-1] or sigma_download < (bitrates[curr+1] / bitrates[curr]):
+                while temp_index + 1 < len(bitrates) and \
+                        (next_rate < bitrates[-1] or sigma_download < (bitrates[curr+1] / bitrates[curr])):
                     temp_index += 1
                     next_rate = bitrates[temp_index]
 
@@ -1,173 +1,722 @@
 import argparse
 import asyncio
+import itertools
+import logging
+import mmap
+import multiprocessing
+import os
+import queue as queue_module
+import signal
 import struct
-from asyncio import Queue
-from collections import deque
+import time
+import weakref
 
 from aioquic.asyncio import serve
+from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.asyncio.server import QuicServer
 from aioquic.quic.configuration import QuicConfiguration
-from src.structures.queues import StrictPriorityQueue, WeightedFairQueue
-from src.structures.data_types import VideoRequestMessage, VideoPacket
-from src.utils import message_to_quic_packet, get_server_file_name, server_file_exists
+from src.structures.queues import FifoQueue, StrictPriorityQueue, WeightedFairQueue, EarliestDeadlineQueue, \
+    PlaybackDeadlines, check_weights
+from src.structures.tile_cache import TileCache
+from src.structures.push_state import PushState
+from src.structures.connection_state import ConnectionState
+from src.structures.egress_scheduler import EgressScheduler
+from src.structures.server_stats import ServerStats, aggregate_stats, format_stats
+from src.structures.data_types import VideoRequestMessage, DATAGRAM_TILE, fragment_tile, deserialize_hello, \
+    is_hello
+from src.structures.catalog import SegmentCatalog, load_videos
+from src.structures.metrics import MetricsRegistry
+from src.structures.event_logger import EventLogger, parse_sample_rates
+from src.structures.session_tickets import SessionTicketStore
+from src.structures.congestion_control import CONGESTION_CONTROLS, install_congestion_control, \
+    get_congestion_sample, get_delivery_rate
+from src.utils import decode_quic_packet
 from src.constants.video_constants import CLOSE_REQUEST, TILE_REQUEST, PUSH_REQUEST, WFQ_QUEUE, SP_QUEUE, \
-    N_SEGMENTS, PUSH_CANCEL, HIGHEST_PRIORITY, PUSH_RECEIVED, INITIAL_BUFFER_SIZE
+    DEFAULT_VIDEO, HELLO_TIMEOUT, PUSH_CANCEL, HIGHEST_PRIORITY, PUSH_RECEIVED, SERVER_FILE_LOCATION, LRU_POLICY, \
+    LFU_POLICY, BINARY_WIRE, LEGACY_WIRE, WFQ_TILE_SIZE, WFQ_REQUEST_SIZE, \
+    WFQ_WEIGHTS, EDF_QUEUE, SEGMENT_DURATION, INITIAL_BUFFER_SIZE, CANCEL_REQUEST, METRICS_LOOP_INTERVAL, \
+    LOW_PRIORITY, DATAGRAM_OFF, DATAGRAM_LOW, DATAGRAM_ALL, DATAGRAM_PAYLOAD_SIZE, RENO_CONTROL
 
 
 def handle_stream(reader, writer):
     asyncio.ensure_future(handle_echo(reader, writer))
 
 
+def create_protocol(quic, stream_handler=None):
+    install_congestion_control(quic, Congestion_Control)
+    return QuicConnectionProtocol(quic, stream_handler=stream_handler)
+
+
 async def handle_echo(reader, writer):
-    closed = False
+    connection = writer.transport.protocol
+    stream_id = writer.get_extra_info("stream_id")
+
+    # The hello only comes on the first stream of the connection, the other streams wait for it and keep their first
+    # message
+    try:
+        message_data, stream_hello = await read_first_message(reader)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return
+
+    hello = Hellos.get(connection)
+    if hello is None:
+        hello = Hellos[connection] = asyncio.get_event_loop().create_future()
+    is_hello_stream = stream_hello is not None
+    if is_hello_stream and not hello.done():
+        hello.set_result(stream_hello)
+
+    try:
+        client, video_id = await asyncio.wait_for(asyncio.shield(hello), HELLO_TIMEOUT)
+    except asyncio.TimeoutError:
+        Event_Log.warning("hello_timeout", stream=stream_id)
+        writer.write_eof()
+        return
+
+    video_id = video_id or Default_Video
+    catalog = Videos.get(video_id)
+    if catalog is None:
+        if is_hello_stream:
+            print("Connection with " + client + " for an unknown video: " + video_id)
+            Event_Log.warning("unknown_video", client=client, video=video_id)
+        writer.write_eof()
+        return
+
+    if is_hello_stream:
+        print("Connection with "+str(client)+", video "+video_id)
 
+    state = Live_Connections.get(connection)
+    if state is None:
+        state = open_connection(connection, client, catalog)
+    state.writers[stream_id] = writer
+
+    await receive(reader, state, stream_id, message_data)
+
+
+def create_queue():
     if Queue_Type == WFQ_QUEUE:
-        queue = WeightedFairQueue()
+        queue = WeightedFairQueue(weights=WFQ_Weights)
+        WFQ_Queues.add(queue)
     elif Queue_Type == SP_QUEUE:
         queue = StrictPriorityQueue()
+    elif Queue_Type == EDF_QUEUE:
+        queue = EarliestDeadlineQueue()
     else:
-        queue = Queue()
+        queue = FifoQueue()
+
+    return queue
+
+
+def open_connection(connection, client, catalog):
+    # The state the streams of the connection share, created with its first stream, and the tasks that serve it
+    Server_Stats.connections += 1
+    Server_Stats.open_connections += 1
+
+    state = ConnectionState(client, str(Server_Stats.connections), catalog, create_queue(),
+                            PushState(Server_Push, Event_Log, client, catalog.n_segments, catalog.max_tile),
+                            PlaybackDeadlines(SEGMENT_DURATION, EDF_Buffer))
+    Live_Connections[connection] = state
 
-    name = await reader.read(1024)
+    asyncio.ensure_future(send_tiles(connection, state))
+    if Server_Push:
+        asyncio.ensure_future(push_scheduler(state))
+    if CC_Sample_Interval > 0:
+        asyncio.ensure_future(sample_congestion(connection, client, state.connection_id, CC_Sample_Interval))
 
-    print("Connection with "+str(name.decode()))
+    return state
+
+
+async def send_tiles(connection, state):
+    # Sends the queued tiles of the connection until all of its streams are closed. A tile whose stream closed is
+    # dropped
+    queue = state.queue
+    push_state = state.push_state
+    client = state.client
+    closed = False
 
-    asyncio.ensure_future(receive(reader, queue))
     while not closed:
         video_request = await queue.get()
-        if video_request.message_type == CLOSE_REQUEST:
-            closed = True
+        if video_request is None:
+            # Every queued tile missed its playback deadline
+            push_state.wakeup.set()
+        elif video_request.message_type == CLOSE_REQUEST:
+            state.writers.pop(video_request.stream_id, None)
+            closed = not state.writers
         else:
-            await send(video_request, writer)
+            writer = state.writer(video_request)
+            contended = Queue_Type == WFQ_QUEUE and queue.contended
+            if writer is not None:
+                if Downgrade_Backlog > 0 and downgrade_bitrate(video_request, state.catalog, queue, connection,
+                                                               client):
+                    state.downgraded += 1
+                sent_bytes = await send(video_request, state.catalog, writer, connection)
+                push_state.sent(video_request.segment, video_request.tile)
+                if Metrics is not None and sent_bytes:
+                    record_send(video_request, sent_bytes)
+                if Event_Log.is_enabled(logging.DEBUG):
+                    Event_Log.debug("tile_sent", client=client, segment=video_request.segment,
+                                    tile=video_request.tile, bitrate=video_request.bitrate,
+                                    priority=video_request.priority, type=video_request.message_type, bytes=sent_bytes)
+                priority = video_request.priority
+                state.priority_bytes[priority] = state.priority_bytes.get(priority, 0) + sent_bytes
+                if contended:
+                    state.contended_bytes[priority] = state.contended_bytes.get(priority, 0) + sent_bytes
 
+            if queue.empty():
+                push_state.wakeup.set()
 
-async def receive(reader, queue):
-    last_segment = 1
-    tiles_priority = deque()
-    previous_tiles_priority = deque()
-    segment = 1
-    closed = False
-    is_pushing = False
+    close_connection(connection, state)
 
-    sent_segments = [False for i in range(1, N_SEGMENTS+1)]
 
-    is_push_allowed = Server_Push
+def close_connection(connection, state):
+    queue = state.queue
+    client = state.client
 
-    while not closed:
-        try:
-            read_data = await asyncio.wait_for(reader.readexactly(4), timeout=0.005)
-            size, = struct.unpack('<L', read_data)
+    state.push_state.close()
+    Live_Connections.pop(connection, None)
+    Server_Stats.open_connections -= 1
 
-            message_data = await reader.readexactly(size)
+    print_congestion_sample(client, connection)
+    if Egress_Scheduler is not None:
+        print("Egress bytes granted to " + client + ": " + str(Egress_Scheduler.remove_client(connection)))
+    if Tile_Cache is not None:
+        print_cache_stats()
+    print_priority_shares(client, "total", state.priority_bytes)
+    print_priority_shares(client, "while priorities compete", state.contended_bytes)
+    Server_Stats.tiles_superseded += queue.superseded
+    Server_Stats.tiles_cancelled += queue.cancelled
+    print("Queued tiles of " + client + " superseded by a new request: " + str(queue.superseded) +
+          ", cancelled: " + str(queue.cancelled))
+    if Queue_Type == EDF_QUEUE:
+        Server_Stats.tiles_dropped += queue.dropped
+        Server_Stats.bytes_dropped += queue.dropped_bytes
+        print("Tiles of " + client + " dropped after their deadline: " + str(queue.dropped) + " (" +
+              str(queue.dropped_bytes) + " bytes)")
+    if Downgrade_Backlog > 0:
+        print("Tiles of " + client + " sent at a lower bitrate because of the backlog: " + str(state.downgraded))
 
-            message = message_to_quic_packet(eval(message_data.decode()))
 
-            if message.end_stream:
-                message_type = CLOSE_REQUEST
-                print("End connection with ", message.stream_id)
+async def read_message(reader):
+    size, = struct.unpack('<L', await reader.readexactly(4))
+    return await reader.readexactly(size)
 
-                priority = HIGHEST_PRIORITY
-                segment = 0
-                tile = 0
-                bitrate = 0
 
-                closed = True
-            elif message.push_status == PUSH_CANCEL:
-                message_type = PUSH_CANCEL
+async def read_first_message(reader):
+    # The first message of a stream, None if it is the hello, and the (client id, video id) of the hello. Clients from
+    # before the framed hello, and legacy ones, write their id without a length prefix. No message is 16 MB long, so a
+    # length whose last byte is not zero is the text of such a hello, read as the server always did. It has no video
+    head = await reader.readexactly(4)
+    if head[3]:
+        client, _ = deserialize_hello(head + await reader.read(1024))
+        return None, (client.strip(), None)
+
+    message_data = await reader.readexactly(struct.unpack('<L', head)[0])
+    if is_hello(message_data):
+        return None, deserialize_hello(message_data)
+    return message_data, None
+
+
+async def receive(reader, state, stream_id, message_data=None):
+    # 'message_data' is a message already read from the stream, handled first
+    push_state = state.push_state
+    closed = False
+
+    while not closed:
+        if message_data is None:
+            try:
+                message_data = await read_message(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # The client went away without ending the stream, the stream is closed as if it had
+                print("Connection lost with ", push_state.client)
+                put_requests(state, CLOSE_REQUEST, 0, [(HIGHEST_PRIORITY, 0, 0)], 0, stream_id)
+                return
+
+        size = len(message_data)
+        message = decode_quic_packet(message_data)
+        message_data = None
 
-                priority = HIGHEST_PRIORITY
-                tile = 0
-                bitrate = 0
+        if message.end_stream:
+            message_type = CLOSE_REQUEST
+            print("End connection with ", message.stream_id)
 
-                is_push_allowed = False
+            segment = 0
+            tiles = [(HIGHEST_PRIORITY, 0, 0)]
+
+            closed = True
+        elif message.push_status == PUSH_CANCEL:
+            message_type = PUSH_CANCEL
+
+            segment = push_state.segment
+            tiles = [(HIGHEST_PRIORITY, 0, 0)]
+
+            push_state.is_push_allowed = False
+        else:
+            if message.push_status == PUSH_RECEIVED:
+                message_type = PUSH_RECEIVED
+            elif message.cancel:
+                message_type = CANCEL_REQUEST
             else:
-                if message.push_status == PUSH_RECEIVED:
-                    message_type = PUSH_RECEIVED
-                else:
-                    message_type = TILE_REQUEST
+                message_type = TILE_REQUEST
 
-                segment = message.video_packet.segment
-                priority = message.video_packet.priority
-                tile = message.video_packet.tile
-                bitrate = message.video_packet.bitrate
-
-                is_pushing = False
-
-                if segment != last_segment and segment <= N_SEGMENTS:
-                    if sent_segments[segment]:
-                        print("SENDING MISSING TILES FROM SEGMENT: ", segment)
-                    else:
-                        tiles_priority = deque()
-                        last_segment = segment
-                        if message_type == TILE_REQUEST:
-                            print("STARTED SENDING SEGMENT: ", segment)
-
-                tiles_priority.appendleft((priority, tile, bitrate))
-
-        except asyncio.TimeoutError:
-            if is_push_allowed:
-                message_type = PUSH_REQUEST
-
-                if INITIAL_BUFFER_SIZE <= segment <= N_SEGMENTS - 1 and segment == last_segment and len(tiles_priority) == 200:
-                    sent_segments[segment] = True
-                    segment += 1
-                    previous_tiles_priority = tiles_priority.copy()
-                    print("PUSHING SEGMENT: ", segment)
-                    is_pushing = True
-
-                if is_pushing and tiles_priority:
-                    priority, tile, bitrate = tiles_priority.pop()
-
-                    if len(tiles_priority) == 0:
-                        tiles_priority = previous_tiles_priority.copy()
-                        last_segment += 1
-                else:
-                    continue
+            if message.segment_request:
+                # A whole segment in one message, expanded here into one queue entry per tile
+                segment = message.segment_request.segment
+                tiles = message.segment_request.get_tiles()
             else:
-                continue
-
-        if segment <= N_SEGMENTS and message_type != PUSH_RECEIVED:
-            data = VideoRequestMessage(message_type, segment, tile, bitrate)
-            if Queue_Type == WFQ_QUEUE:
-                queue.put_nowait((priority, size, data))
-            elif Queue_Type == SP_QUEUE:
-                queue.put_nowait((priority, data))
+                segment = message.video_packet.segment
+                tiles = [(message.video_packet.priority, message.video_packet.tile, message.video_packet.bitrate)]
+
+            if message_type == CANCEL_REQUEST:
+                push_state.cancelled(segment, tiles)
+            elif message_type == PUSH_RECEIVED:
+                push_state.acknowledged(segment, tiles)
             else:
-                queue.put_nowait(data)
-
-
-async def send(message: VideoRequestMessage, writer):
-    global Server_Log
-    segment = message.segment
-    tile = message.tile
-    bitrate = message.bitrate
-
-    video_info = VideoPacket(segment=segment, tile=tile, bitrate=bitrate)
-    data = video_info.serialize()
-
-    file_name = get_server_file_name(
-        segment=segment, tile=tile, bitrate=bitrate)
-
-    if server_file_exists(file_name):
-        if Server_Log:
-            print("Sending file: ", file_name)
-        writer.write(struct.pack('<L', len(data)))
-        writer.write(data)
-
-        with open(file_name, "rb") as video_file:
-            not_finished = True
-            chunk_n = 1
-            while not_finished:
-                chunk = video_file.read(1024)
-                if not chunk:
-                    writer.write(struct.pack('<L', 0))
-                    not_finished = False
-                else:
-                    writer.write(struct.pack('<L', len(chunk)))
-                    writer.write(chunk)
-                    chunk_n += 1
-    elif Server_Log:
-        print("Couldn't find file:", file_name)
+                push_state.request_size = size
+                push_state.requested(segment, tiles, message_type == TILE_REQUEST)
+
+        if message_type == CANCEL_REQUEST:
+            for _, tile, _ in tiles:
+                state.queue.cancel(segment, tile)
+        elif message_type != PUSH_RECEIVED:
+            put_requests(state, message_type, segment, tiles, size, stream_id)
+
+
+async def push_scheduler(state):
+    # Pushes the next segment's tiles one at a time, only while the connection queue is empty, so pushed tiles never
+    # delay requested ones
+    queue = state.queue
+    push_state = state.push_state
+    while not push_state.closed:
+        await push_state.wakeup.wait()
+        push_state.wakeup.clear()
+
+        while push_state.is_push_allowed and not push_state.closed and queue.empty():
+            tile = push_state.next_push_tile()
+            if tile is None:
+                break
+
+            put_requests(state, PUSH_REQUEST, push_state.segment, [tile], push_state.request_size)
+
+
+def put_requests(state, message_type, segment, tiles, size, stream_id=None):
+    catalog = state.catalog
+    queue = state.queue
+    if segment > catalog.n_segments:
+        return
+
+    if message_type == TILE_REQUEST:
+        Server_Stats.requests += len(tiles)
+
+    deadline = None
+    if Queue_Type == EDF_QUEUE and message_type in (TILE_REQUEST, PUSH_REQUEST):
+        deadline = state.deadlines.deadline(segment, message_type == TILE_REQUEST)
+
+    for priority, tile, bitrate in tiles:
+        data = VideoRequestMessage(message_type, segment, tile, bitrate, priority)
+        data.size = get_tile_size(catalog, segment, tile, bitrate)
+        data.stream_id = stream_id
+        if message_type == TILE_REQUEST:
+            state.priority_streams[priority] = stream_id
+        if Metrics is not None:
+            data.queued_at = time.monotonic()
+        if Queue_Type == WFQ_QUEUE:
+            queue.put_nowait((priority, get_wfq_size(catalog, segment, tile, bitrate, size), data))
+        elif Queue_Type == SP_QUEUE:
+            queue.put_nowait((priority, data))
+        elif Queue_Type == EDF_QUEUE:
+            queue.put_nowait((priority, deadline, data.size, data))
+        else:
+            queue.put_nowait(data)
+
+
+def get_wfq_size(catalog, segment, tile, bitrate, request_size):
+    # WFQ finish times are computed from the bytes each request will put on the wire: the tile size from the catalog,
+    # or the request message size when comparing with the previous behaviour
+    if WFQ_Size == WFQ_REQUEST_SIZE:
+        return request_size
+
+    return get_tile_size(catalog, segment, tile, bitrate)
+
+
+def get_tile_size(catalog, segment, tile, bitrate):
+    index = catalog.index(segment=segment, tile=tile, bitrate=bitrate)
+    return max(catalog.sizes[index], 0) if index >= 0 else 0
+
+
+async def send(message: VideoRequestMessage, catalog, writer, connection):
+    index = catalog.index(segment=message.segment, tile=message.tile, bitrate=message.bitrate)
+    tile_size = catalog.sizes[index] if index >= 0 else -1
+
+    tile_data = None
+    if tile_size >= 0 and Tile_Cache is not None:
+        tile_data = Tile_Cache.get(catalog.paths[index])
+        if tile_data is None:
+            tile_size = -1
+
+    if tile_size < 0:
+        Event_Log.warning("tile_not_found", segment=message.segment, tile=message.tile, bitrate=message.bitrate,
+                          file=catalog.paths[index] if index >= 0 else None)
+        return 0
+
+    file_name = catalog.paths[index]
+    header = catalog.header(index)
+
+    if Egress_Scheduler is not None:
+        await Egress_Scheduler.transmit(connection, len(header) + tile_size)
+
+    writer.write(header)
+
+    if use_datagrams(message, connection):
+        if tile_data is None:
+            with open(file_name, "rb") as video_file:
+                tile_data = video_file.read()
+        write_tile_datagrams(message, tile_data, writer, connection)
+        Server_Stats.tiles_datagram += 1
+    elif tile_data is not None:
+        write_tile(tile_data, writer)
+    else:
+        write_tile_file(file_name, writer)
+
+    Server_Stats.tiles_sent += 1
+    Server_Stats.bytes_sent += tile_size
+    if message.message_type == PUSH_REQUEST:
+        Server_Stats.tiles_pushed += 1
+
+    return tile_size
+
+
+def get_backlog_bytes(queue, connection):
+    # Tile bytes still queued plus the stream data written and not acknowledged yet
+    buffered = sum(stream._send_buffer_stop - stream._send_buffer_start
+                   for stream in connection._quic._streams.values())
+    return queue.queued_bytes + buffered
+
+
+def downgrade_bitrate(message, catalog, queue, connection, client):
+    # Substitutes the tile with the next lower bitrate when the backlog of the connection would take more than
+    # Downgrade_Backlog seconds to drain at its estimated delivery rate: LOW_PRIORITY tiles past the threshold, every
+    # tile past twice the threshold. The header sent with the tile carries the new bitrate
+    if message.message_type not in (TILE_REQUEST, PUSH_REQUEST):
+        return False
+
+    rate = get_delivery_rate(connection._quic)
+    if not rate:
+        return False
+
+    drain_time = get_backlog_bytes(queue, connection) / rate
+    if drain_time <= Downgrade_Backlog or (message.priority < LOW_PRIORITY and drain_time <= 2 * Downgrade_Backlog):
+        return False
+
+    bitrate = catalog.lower_bitrate(message.segment, message.tile, message.bitrate)
+    if bitrate is None:
+        return False
+
+    Event_Log.debug("tile_downgraded", client=client, segment=message.segment, tile=message.tile,
+                    priority=message.priority, requested_bitrate=message.bitrate, bitrate=bitrate,
+                    drain_time=drain_time)
+    message.bitrate = bitrate
+    Server_Stats.tiles_downgraded += 1
+    if Metrics is not None:
+        Metrics.inc("tcc_tiles_downgraded_total", priority=message.priority)
+    return True
+
+
+def write_tile(tile, writer):
+    # The whole tile goes out as a single chunk followed by the end-of-tile marker
+    if len(tile) > 0:
+        writer.write(struct.pack('<L', len(tile)))
+        writer.write(tile)
+
+    writer.write(struct.pack('<L', 0))
+
+
+def write_tile_file(file_name, writer):
+    # The tile is memory-mapped, so the stream buffer receives the page cache contents without intermediate bytes
+    # objects
+    with open(file_name, "rb") as video_file:
+        if os.fstat(video_file.fileno()).st_size == 0:
+            write_tile(b'', writer)
+            return
+
+        with mmap.mmap(video_file.fileno(), 0, access=mmap.ACCESS_READ) as tile_map, memoryview(tile_map) as tile:
+            write_tile(tile, writer)
+
+
+def use_datagrams(message, connection):
+    if Datagram_Mode == DATAGRAM_OFF or (Datagram_Mode == DATAGRAM_LOW and message.priority < LOW_PRIORITY):
+        return False
+
+    # Only clients that accept DATAGRAM frames (max_datagram_frame_size transport parameter). aioquic 0.9 does not
+    # expose the peer's value
+    return connection._quic._remote_max_datagram_frame_size is not None
+
+
+def write_tile_datagrams(message, tile, writer, connection):
+    # The tile body goes out in DATAGRAM frames, which are never retransmitted. The stream only carries the header and
+    # the sequence number, so the client can time out the tile even if all of its fragments are lost
+    sequence = next(Datagram_Sequence) & 0xFFFFFFFF
+    writer.write(struct.pack('<LL', DATAGRAM_TILE, sequence))
+
+    for fragment in fragment_tile(sequence, message.segment, message.tile, message.bitrate, tile,
+                                  DATAGRAM_PAYLOAD_SIZE):
+        connection._quic.send_datagram_frame(fragment)
+    connection.transmit()
+
+
+def create_metrics():
+    metrics = MetricsRegistry()
+    metrics.counter("tcc_tiles_sent_total", "Tiles sent, by type (tile for requested, push for pushed)")
+    metrics.counter("tcc_bytes_sent_total", "Tile bytes sent, by type (tile for requested, push for pushed)")
+    metrics.counter("tcc_tiles_downgraded_total", "Tiles sent at a lower bitrate because of the backlog, by priority")
+    metrics.gauge("tcc_tiles_sent_per_second", "Tiles sent per second over the last event loop check")
+    metrics.gauge("tcc_bytes_sent_per_second", "Tile bytes sent per second over the last event loop check")
+    metrics.gauge("tcc_open_connections", "Open client connections")
+    metrics.gauge("tcc_queue_depth", "Queued tiles of each connection, by priority")
+    metrics.gauge("tcc_queue_depth_total", "Queued tiles of all the connections, by priority")
+    metrics.histogram("tcc_send_latency_seconds", "Time from enqueue to send of each tile, by priority",
+                      [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10])
+    metrics.histogram("tcc_event_loop_lag_seconds", "Delay of the event loop in waking up a periodic check",
+                      [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1])
+    metrics.gauge("tcc_congestion_window_bytes", "Congestion window of each connection")
+    metrics.gauge("tcc_bytes_in_flight", "Bytes in flight of each connection")
+    metrics.gauge("tcc_smoothed_rtt_seconds", "Smoothed RTT of each connection")
+    metrics.gauge("tcc_min_rtt_seconds", "Minimum RTT of each connection")
+    metrics.gauge("tcc_pacing_rate_bytes_per_second", "Pacing rate of each connection")
+    metrics.add_collector(collect_queue_metrics)
+    metrics.add_collector(collect_congestion_metrics)
+    return metrics
+
+
+def collect_queue_metrics():
+    samples = [("tcc_open_connections", {}, Server_Stats.open_connections)]
+    total = {}
+    for state in list(Live_Connections.values()):
+        for priority, depth in state.queue.get_depth().items():
+            labels = {'client': state.client, 'connection': state.connection_id, 'priority': priority}
+            samples.append(("tcc_queue_depth", labels, depth))
+            total[priority] = total.get(priority, 0) + depth
+
+    samples += [("tcc_queue_depth_total", {'priority': priority}, depth) for priority, depth in total.items()]
+    return samples
+
+
+def collect_congestion_metrics():
+    samples = []
+    for connection, state in list(Live_Connections.items()):
+        sample = get_congestion_sample(connection._quic)
+        labels = {'client': state.client, 'connection': state.connection_id, 'algorithm': Congestion_Control}
+        for name, key in (("tcc_congestion_window_bytes", 'cwnd'), ("tcc_bytes_in_flight", 'bytes_in_flight'),
+                          ("tcc_smoothed_rtt_seconds", 'smoothed_rtt'), ("tcc_min_rtt_seconds", 'min_rtt'),
+                          ("tcc_pacing_rate_bytes_per_second", 'pacing_rate')):
+            if sample[key] is not None:
+                samples.append((name, labels, sample[key]))
+    return samples
+
+
+async def sample_congestion(connection, client, connection_id, interval):
+    # Logs the congestion state of the connection every 'interval' seconds while it is open
+    while connection in Live_Connections:
+        Event_Log.info("congestion_sample", client=client, connection=connection_id, algorithm=Congestion_Control,
+                       **get_congestion_sample(connection._quic))
+        await asyncio.sleep(interval)
+
+
+def record_send(message, sent_bytes):
+    Metrics.inc("tcc_tiles_sent_total", type=message.message_type)
+    Metrics.inc("tcc_bytes_sent_total", sent_bytes, type=message.message_type)
+    if message.queued_at is not None:
+        Metrics.observe("tcc_send_latency_seconds", time.monotonic() - message.queued_at, priority=message.priority)
+
+
+async def monitor_event_loop(interval):
+    # Measures how late the loop wakes up this task, and the send rates since the previous check
+    last_tiles, last_bytes = Server_Stats.tiles_sent, Server_Stats.bytes_sent
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        elapsed = time.monotonic() - start
+
+        Metrics.observe("tcc_event_loop_lag_seconds", max(elapsed - interval, 0))
+        Metrics.set("tcc_tiles_sent_per_second", (Server_Stats.tiles_sent - last_tiles) / elapsed)
+        Metrics.set("tcc_bytes_sent_per_second", (Server_Stats.bytes_sent - last_bytes) / elapsed)
+        last_tiles, last_bytes = Server_Stats.tiles_sent, Server_Stats.bytes_sent
+
+
+async def handle_metrics(reader, writer):
+    # Minimal HTTP/1.0 endpoint for Prometheus scrapes: GET /metrics
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+
+        parts = request_line.decode(errors='replace').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", Metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+
+        writer.write(("HTTP/1.0 " + status + "\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " +
+                      str(len(body)) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def start_metrics(host, port):
+    asyncio.ensure_future(asyncio.start_server(handle_metrics, host, port))
+    asyncio.ensure_future(monitor_event_loop(METRICS_LOOP_INTERVAL))
+    print("Metrics on http://" + host + ":" + str(port) + "/metrics")
+
+
+def create_event_log(settings):
+    output, level, sample_rates = settings
+    return EventLogger(output, level, sample_rates)
+
+
+def parse_weights(text):
+    return check_weights(text.replace(',', ' ').split())
+
+
+def reload_wfq_weights():
+    # SIGHUP handler: applies the weights in the weights file to new and live WFQ queues
+    global WFQ_Weights
+    try:
+        with open(WFQ_Weights_File) as weights_file:
+            weights = parse_weights(weights_file.read())
+        for queue in list(WFQ_Queues):
+            queue.set_weights(weights)
+    except (OSError, ValueError) as err:
+        print("Could not reload the WFQ weights:", err)
+        return
+
+    WFQ_Weights = weights
+    print("WFQ weights:", WFQ_Weights)
+
 
+def install_weights_reload(loop):
+    if WFQ_Weights_File:
+        loop.add_signal_handler(signal.SIGHUP, reload_wfq_weights)
+
+
+def get_worker_stats():
+    stats = Server_Stats.get_stats()
+    stats['tickets_issued'] = Ticket_Store.issued
+    stats['sessions_resumed'] = Ticket_Store.resumed
+    if Tile_Cache is not None:
+        for key, value in Tile_Cache.get_stats().items():
+            stats['cache_' + key] = value
+    return stats
+
+
+async def report_stats(index, stats_queue, interval):
+    while True:
+        await asyncio.sleep(interval)
+        stats_queue.put((index, get_worker_stats()))
+
+
+def run_worker(index, host, port, configuration, stats_queue, interval):
+    # Every worker binds the same UDP port with SO_REUSEPORT. The kernel hashes the datagram 4-tuple, so all the
+    # packets of a connection (retransmits included) reach the worker that accepted it
+    global Event_Log
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # The logger thread of the parent process does not exist in the forked worker
+    Event_Log = create_event_log(Event_Log_Settings)
+
+    loop.run_until_complete(
+        loop.create_datagram_endpoint(
+            lambda: QuicServer(configuration=configuration, create_protocol=create_protocol,
+                               stream_handler=handle_stream, session_ticket_fetcher=Ticket_Store.pop,
+                               session_ticket_handler=Ticket_Store.add),
+            local_addr=(host, port),
+            reuse_port=True,
+        )
+    )
+    print("Worker " + str(index) + " started on process " + str(os.getpid()))
+
+    install_weights_reload(loop)
+    if Metrics is not None:
+        start_metrics(Metrics_Host, Metrics_Port + index)
+
+    asyncio.ensure_future(report_stats(index, stats_queue, interval))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        Event_Log.close()
+
+
+def run_workers(n_workers, host, port, configuration, interval):
+    context = multiprocessing.get_context('fork')
+    stats_queue = context.Queue()
+    workers = [context.Process(target=run_worker, args=(index, host, port, configuration, stats_queue, interval),
+                               daemon=True)
+               for index in range(n_workers)]
+
+    for worker in workers:
+        worker.start()
+
+    if WFQ_Weights_File:
+        signal.signal(signal.SIGHUP, lambda signum, frame: [os.kill(worker.pid, signal.SIGHUP) for worker in workers])
+
+    worker_stats = {}
+    last_report = None
+    try:
+        while any(worker.is_alive() for worker in workers):
+            deadline = time.monotonic() + interval
+            while time.monotonic() < deadline:
+                try:
+                    index, stats = stats_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue_module.Empty:
+                    break
+                worker_stats[index] = stats
+
+            report = sorted(worker_stats.items())
+            if worker_stats and report != last_report:
+                print_worker_stats(worker_stats)
+                last_report = report
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+def print_worker_stats(worker_stats):
+    for index in sorted(worker_stats):
+        print("Worker " + str(index) + ": " + format_stats(worker_stats[index]))
+    print("All workers: " + format_stats(aggregate_stats(worker_stats.values())))
+
+
+def print_priority_shares(client, label, priority_bytes):
+    total = sum(priority_bytes.values())
+    if total == 0:
+        return
+
+    shares = []
+    for priority in sorted(priority_bytes, key=str):
+        shares.append("priority " + str(priority) + ": " + str(priority_bytes[priority]) + " bytes (" +
+                      str(round(priority_bytes[priority] / total * 100, 2)) + "%)")
+    print("Bandwidth shares of " + client + " with " + Queue_Type + " (" + WFQ_Size + " sizes), " + label + ": " +
+          ", ".join(shares))
+
+
+def print_congestion_sample(client, connection):
+    sample = get_congestion_sample(connection._quic)
+    print("Congestion control of " + client + " (" + Congestion_Control + "): cwnd=" + str(sample['cwnd']) +
+          " smoothed_rtt=" + str(round(sample['smoothed_rtt'], 4)) +
+          " min_rtt=" + str(sample['min_rtt'] and round(sample['min_rtt'], 4)) +
+          " pacing_rate=" + str(sample['pacing_rate'] and round(sample['pacing_rate'])))
+
+
+def print_cache_stats():
+    stats = Tile_Cache.get_stats()
+    print("Tile cache: hits=" + str(stats['hits']) + " misses=" + str(stats['misses']) + " evictions=" +
+          str(stats['evictions']) + " tiles=" + str(stats['tiles']) + " bytes=" + str(stats['bytes']))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="QUIC Video Server")
@@ -203,7 +752,33 @@ if __name__ == "__main__":
         "--queue",
         type=str,
         default="FIFO",
-        help="the type of Queuing used by the server",
+        help="the type of Queuing used by the server (FIFO, SP, WFQ or EDF)",
+    )
+    parser.add_argument(
+        "--edf-buffer",
+        type=float,
+        default=INITIAL_BUFFER_SIZE * SEGMENT_DURATION,
+        help="seconds of playback buffer added to the EDF deadlines, tiles still queued after their deadline are "
+             "dropped (defaults to the client initial buffer, 2)",
+    )
+    parser.add_argument(
+        "--wfq-size",
+        type=str,
+        choices=[WFQ_TILE_SIZE, WFQ_REQUEST_SIZE],
+        default=WFQ_TILE_SIZE,
+        help="packet size used by WFQ: the tile file or the request message, to compare bandwidth shares "
+             "(defaults to tile)",
+    )
+    parser.add_argument(
+        "--wfq-weights",
+        type=str,
+        default=",".join(str(weight) for weight in WFQ_WEIGHTS),
+        help="comma separated bandwidth share of each WFQ priority class (defaults to 0.75,0.25)",
+    )
+    parser.add_argument(
+        "--wfq-weights-file",
+        type=str,
+        help="file with WFQ weights that is read again on SIGHUP, replacing the weights of live connections",
     )
     parser.add_argument(
         "-v",
@@ -217,15 +792,223 @@ if __name__ == "__main__":
         help="enable server push",
         action="store_true",
     )
+    parser.add_argument(
+        "-w",
+        "--wire-format",
+        type=str,
+        choices=[BINARY_WIRE, LEGACY_WIRE],
+        default=BINARY_WIRE,
+        help="encoding of the response headers, requests are accepted in both (defaults to binary)",
+    )
+    parser.add_argument(
+        "--datagrams",
+        type=str,
+        choices=[DATAGRAM_OFF, DATAGRAM_LOW, DATAGRAM_ALL],
+        default=DATAGRAM_OFF,
+        help="send the LOW_PRIORITY tiles (low) or every tile (all) in unreliable QUIC DATAGRAM frames to the clients "
+             "that accept them (defaults to off)",
+    )
+    parser.add_argument(
+        "--downgrade-backlog",
+        type=float,
+        default=0,
+        help="seconds of backlog (queued and unacknowledged bytes over the estimated delivery rate) above which the "
+             "LOW_PRIORITY tiles of a connection are sent at the next lower bitrate, and every tile above twice that "
+             "(defaults to 0, disabled)",
+    )
+    parser.add_argument(
+        "--congestion-control",
+        type=str,
+        choices=sorted(CONGESTION_CONTROLS),
+        default=RENO_CONTROL,
+        help="congestion control of the client connections: aioquic's NewReno (reno) or a BBR style controller that "
+             "paces at the estimated bottleneck bandwidth (bbr) (defaults to reno)",
+    )
+    parser.add_argument(
+        "--cc-sample-interval",
+        type=float,
+        default=0,
+        help="seconds between the congestion_sample events (cwnd, RTT and pacing rate) of each connection "
+             "(defaults to 0, disabled)",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        action="append",
+        metavar="[VIDEO_ID=]PATH",
+        help="MPD of a video to serve, one per client bitrate, repeatable for several videos. The video id defaults to "
+             "the name of the manifest's folder, and the first video is the one of the clients that do not ask for one "
+             "(defaults to the single video in " + SERVER_FILE_LOCATION + ")",
+    )
+    parser.add_argument(
+        "--catalog-file",
+        type=str,
+        help="sidecar file with the segment catalog sizes, created at startup if it does not exist (only for the "
+             "video in " + SERVER_FILE_LOCATION + ", without --manifest)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=0,
+        help="size of the in-memory tile cache in MB (defaults to 0, no cache)",
+    )
+    parser.add_argument(
+        "--cache-policy",
+        type=str,
+        choices=[LRU_POLICY, LFU_POLICY],
+        default=LRU_POLICY,
+        help="eviction policy of the tile cache (defaults to LRU)",
+    )
+    parser.add_argument(
+        "--preload",
+        help="load the video segments into the tile cache at startup",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fair-egress",
+        help="share the egress between clients with a server-wide Deficit Round Robin scheduler, paced at "
+             "--egress-rate, which it requires",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--egress-rate",
+        type=float,
+        default=0,
+        help="egress rate of the fair scheduler in Mbps, the link capacity it shares. Without it every grant would "
+             "be immediate and the scheduler would not hold any client back",
+    )
+    parser.add_argument(
+        "--drr-quantum",
+        type=int,
+        default=65536,
+        help="bytes credited to each client per round of the fair scheduler (defaults to 65536)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of server processes sharing the UDP port (defaults to 1)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="serve Prometheus metrics over HTTP on this port, worker N uses port + N (defaults to 0, disabled)",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        type=str,
+        default="127.0.0.1",
+        help="address of the metrics endpoint (defaults to 127.0.0.1)",
+    )
+    parser.add_argument(
+        "--event-log",
+        type=str,
+        help="file the JSON lines events are appended to (defaults to the standard error, so the standard output "
+             "only has the summaries)",
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        choices=["DEBUG", "INFO", "WARNING"],
+        default="INFO",
+        help="lowest level of the logged events, -v sets DEBUG (defaults to INFO)",
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=str,
+        default="",
+        help="comma separated event=N pairs, logging one of every N of those events (e.g. tile_sent=100)",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=5,
+        help="seconds between the aggregated worker reports (defaults to 5)",
+    )
 
     args = parser.parse_args()
 
-    Server_Log = args.verbose
+    if args.preload and args.cache_size <= 0:
+        parser.error("--preload requires a --cache-size")
+    if args.fair_egress and args.egress_rate <= 0:
+        parser.error("--fair-egress requires an --egress-rate")
+
+    try:
+        Event_Log_Settings = (args.event_log, logging.DEBUG if args.verbose else getattr(logging, args.log_level),
+                              parse_sample_rates(args.log_sample))
+    except ValueError as err:
+        parser.error(str(err))
+    Event_Log = None
 
     Queue_Type = args.queue
 
+    EDF_Buffer = args.edf_buffer
+
+    WFQ_Size = args.wfq_size
+
+    try:
+        WFQ_Weights = parse_weights(args.wfq_weights)
+    except ValueError as err:
+        parser.error(str(err))
+    WFQ_Weights_File = args.wfq_weights_file
+    WFQ_Queues = weakref.WeakSet()
+    Hellos = weakref.WeakKeyDictionary()  # Connection -> future of its (client id, video id)
+
     Server_Push = args.push
 
+    Wire_Format = args.wire_format
+
+    # Session tickets let returning clients resume with 0-RTT. Each worker only knows the tickets it issued
+    Ticket_Store = SessionTicketStore()
+
+    Datagram_Mode = args.datagrams
+
+    Downgrade_Backlog = args.downgrade_backlog
+
+    Congestion_Control = args.congestion_control
+    CC_Sample_Interval = args.cc_sample_interval
+    Datagram_Sequence = itertools.count()
+
+    Server_Stats = ServerStats()
+
+    Live_Connections = {}  # Connection -> ConnectionState
+    Metrics = create_metrics() if args.metrics_port else None
+    Metrics_Host = args.metrics_host
+    Metrics_Port = args.metrics_port
+
+    if args.manifest:
+        try:
+            Videos = load_videos(args.manifest, Wire_Format)
+        except (ValueError, OSError) as err:
+            parser.error(str(err))
+        for video_id, catalog in Videos.items():
+            print("Video " + video_id + ": " + str(catalog.scan()) + " of " + str(len(catalog)) + " tiles found")
+    else:
+        catalog = SegmentCatalog(Wire_Format)
+        if args.catalog_file and os.path.isfile(args.catalog_file) and catalog.load(args.catalog_file):
+            print("Segment catalog loaded from " + args.catalog_file)
+        else:
+            print("Segment catalog: " + str(catalog.scan()) + " of " + str(len(catalog)) + " tiles found")
+            if args.catalog_file:
+                catalog.save(args.catalog_file)
+        Videos = {DEFAULT_VIDEO: catalog}
+    Default_Video = next(iter(Videos))
+
+    Egress_Scheduler = None
+    if args.fair_egress:
+        Egress_Scheduler = EgressScheduler(args.drr_quantum, args.egress_rate * 1000000 / 8)
+
+    Tile_Cache = None
+    if args.cache_size > 0:
+        Tile_Cache = TileCache(int(args.cache_size * 1024 * 1024), args.cache_policy)
+
+        if args.preload:
+            folders = sorted({os.path.dirname(path) for catalog in Videos.values() for path in catalog.paths if path})
+            for folder in folders:
+                print("Preloading tiles from " + folder)
+                print(str(Tile_Cache.preload(folder)) + " tiles preloaded")
+
     configuration = QuicConfiguration(
         is_client=False,
         max_datagram_frame_size=65536
@@ -233,14 +1016,28 @@ if __name__ == "__main__":
 
     configuration.load_cert_chain(args.certificate, args.private_key)
 
-    print("Starting Server")
-    asyncio.ensure_future(
-        serve(args.host,
-              args.port,
-              configuration=configuration,
-              stream_handler=handle_stream
-              )
-    )
+    if args.workers > 1:
+        print("Starting Server with " + str(args.workers) + " workers")
+        run_workers(args.workers, args.host, args.port, configuration, args.stats_interval)
+    else:
+        print("Starting Server")
+        Event_Log = create_event_log(Event_Log_Settings)
+        asyncio.ensure_future(
+            serve(args.host,
+                  args.port,
+                  configuration=configuration,
+                  create_protocol=create_protocol,
+                  stream_handler=handle_stream,
+                  session_ticket_fetcher=Ticket_Store.pop,
+                  session_ticket_handler=Ticket_Store.add
+                  )
+        )
 
-    loop = asyncio.get_event_loop()
-    loop.run_forever()
+        loop = asyncio.get_event_loop()
+        install_weights_reload(loop)
+        if Metrics is not None:
+            start_metrics(Metrics_Host, Metrics_Port)
+        try:
+            loop.run_forever()
+        finally:
+            Event_Log.close()
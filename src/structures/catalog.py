@@ -0,0 +1,142 @@
+import os
+import struct
+from array import array
+
+from src.structures.data_types import VideoPacket
+from src.structures.manifest import Manifest
+from src.utils import get_server_file_name
+from src.constants.video_constants import N_SEGMENTS, MAX_TILE, CLIENT_BITRATES, BINARY_WIRE
+
+CATALOG_MAGIC = b'TCAT'
+CATALOG_HEADER_STRUCT = struct.Struct('<4sHHH')  # magic, segments, tiles, number of bitrates
+
+
+class SegmentCatalog:
+    # Index of every (segment, tile, bitrate) the server can send, built once at startup.
+    #
+    # Entries are addressed by an integer, (bitrate index * segments + segment - 1) * tiles + tile - 1, and kept in
+    # flat arrays: the file size (-1 when the file does not exist), the file path and the response header already
+    # serialized with its length prefix. The headers live in a single buffer delimited by an offsets array.
+    #
+    # 'file_name' gives the path of a (segment, tile, bitrate), None when the video has no such file. It defaults to
+    # the naming scheme of the constants
+
+    def __init__(self, wire_format=BINARY_WIRE, n_segments=N_SEGMENTS, max_tile=MAX_TILE, bitrates=CLIENT_BITRATES,
+                 file_name=get_server_file_name):
+        self.n_segments = n_segments
+        self.max_tile = max_tile
+        self.bitrates = [int(bitrate) for bitrate in bitrates]
+        self.bitrate_index = {bitrate: index for index, bitrate in enumerate(self.bitrates)}
+
+        length = len(self.bitrates) * n_segments * max_tile
+        self.sizes = array('q', [-1]) * length
+        self.paths = []
+
+        headers = bytearray()
+        self._header_offsets = array('L', [0])
+        for bitrate in self.bitrates:
+            for segment in range(1, n_segments + 1):
+                for tile in range(1, max_tile + 1):
+                    self.paths.append(file_name(segment=segment, tile=tile, bitrate=bitrate) or '')
+
+                    header = VideoPacket(segment=segment, tile=tile, bitrate=bitrate).serialize(wire_format)
+                    headers += struct.pack('<L', len(header)) + header
+                    self._header_offsets.append(len(headers))
+
+        self._headers = memoryview(bytes(headers))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def index(self, segment, tile, bitrate):
+        # -1 when the tile is outside the catalog
+        bitrate_index = self.bitrate_index.get(int(bitrate))
+        if bitrate_index is None or not 1 <= segment <= self.n_segments or not 1 <= tile <= self.max_tile:
+            return -1
+        return (bitrate_index * self.n_segments + segment - 1) * self.max_tile + tile - 1
+
+    def lower_bitrate(self, segment, tile, bitrate):
+        # Highest bitrate below 'bitrate' that has a file for the tile, or None
+        for lower in sorted((other for other in self.bitrates if other < int(bitrate)), reverse=True):
+            if self.sizes[self.index(segment=segment, tile=tile, bitrate=lower)] >= 0:
+                return lower
+        return None
+
+    def header(self, index):
+        return self._headers[self._header_offsets[index]:self._header_offsets[index + 1]]
+
+    def scan(self):
+        # Stats every file of the catalog. Returns the number of existing files
+        found = 0
+        for index, path in enumerate(self.paths):
+            try:
+                self.sizes[index] = os.stat(path).st_size
+                found += 1
+            except FileNotFoundError:
+                self.sizes[index] = -1
+        return found
+
+    def save(self, file_name):
+        with open(file_name, "wb") as catalog_file:
+            catalog_file.write(CATALOG_HEADER_STRUCT.pack(CATALOG_MAGIC, self.n_segments, self.max_tile,
+                                                          len(self.bitrates)))
+            array('H', self.bitrates).tofile(catalog_file)
+            self.sizes.tofile(catalog_file)
+
+    def load(self, file_name):
+        # Loads the sizes from a sidecar file written by save(). Returns False if it describes another catalog or is
+        # truncated
+        with open(file_name, "rb") as catalog_file:
+            try:
+                magic, n_segments, max_tile, n_bitrates = CATALOG_HEADER_STRUCT.unpack(
+                    catalog_file.read(CATALOG_HEADER_STRUCT.size))
+
+                bitrates = array('H')
+                bitrates.fromfile(catalog_file, n_bitrates)
+                if magic != CATALOG_MAGIC or (n_segments, max_tile, list(bitrates)) != \
+                        (self.n_segments, self.max_tile, self.bitrates):
+                    return False
+
+                sizes = array('q')
+                sizes.fromfile(catalog_file, len(self.sizes))
+            except (EOFError, ValueError, struct.error):
+                return False
+
+            self.sizes = sizes
+
+        return True
+
+
+def load_videos(manifests, wire_format=BINARY_WIRE):
+    # Builds the catalog of each video from '[video id=]path' MPD specs. The manifests of a video are its bitrates, and
+    # the id defaults to the name of the manifest's folder. The clients only request CLIENT_BITRATES, so a video needs a
+    # manifest for each, mapped onto them in order of bandwidth. Returns {video id: SegmentCatalog}, in the given order
+    videos = {}
+    for spec in manifests:
+        video_id, path = spec.split('=', 1) if '=' in spec else (None, spec)
+        video_id = video_id or os.path.basename(os.path.dirname(os.path.abspath(path)))
+        if not video_id or ' ' in video_id:
+            raise ValueError("Invalid video id: '" + video_id + "'")
+
+        videos.setdefault(video_id, []).append(Manifest(path))
+
+    catalogs = {}
+    for video_id, manifests in videos.items():
+        if len(manifests) != len(CLIENT_BITRATES):
+            raise ValueError("Video " + video_id + " has " + str(len(manifests)) + " manifests, the clients request " +
+                             str(len(CLIENT_BITRATES)) + " bitrates " + str(CLIENT_BITRATES))
+        manifests.sort(key=lambda manifest: manifest.bandwidth)
+        if len({manifest.bandwidth for manifest in manifests}) < len(manifests):
+            raise ValueError("Video " + video_id + " has manifests of the same bandwidth")
+        bitrates = dict(zip(sorted(CLIENT_BITRATES), manifests))
+
+        max_tile = max(manifest.max_tile for manifest in bitrates.values())
+        if max_tile > MAX_TILE:
+            # The segment requests carry a bitmap of MAX_TILE tiles
+            raise ValueError("Video " + video_id + " has " + str(max_tile) + " tiles, the maximum is " + str(MAX_TILE))
+
+        catalogs[video_id] = SegmentCatalog(
+            wire_format, max(manifest.n_segments for manifest in bitrates.values()), max_tile, sorted(bitrates),
+            lambda segment, tile, bitrate, bitrates=bitrates: bitrates[bitrate].file(segment, tile))
+
+    return catalogs
@@ -0,0 +1,296 @@
+import math
+import random
+from collections import deque
+
+from aioquic.quic.recovery import QuicCongestionControl, QuicPacketPacer, K_MAX_DATAGRAM_SIZE, K_INITIAL_WINDOW, \
+    K_MICRO_SECOND, K_SECOND
+
+from src.constants.video_constants import RENO_CONTROL, BBR_CONTROL
+
+# BBR parameters
+HIGH_GAIN = 2.885  # 2 / ln(2), doubles the sending rate every round trip
+PROBE_BW_GAINS = [1.25, 0.75, 1, 1, 1, 1, 1, 1]
+PROBE_BW_CWND_GAIN = 2
+BTL_BW_ROUNDS = 10  # round trips of the bottleneck bandwidth max filter
+MIN_RTT_WINDOW = 10  # seconds before the min RTT has to be measured again
+PROBE_RTT_DURATION = 0.2  # seconds
+FULL_BW_GROWTH = 1.25
+FULL_BW_ROUNDS = 3
+BBR_MINIMUM_WINDOW = 4 * K_MAX_DATAGRAM_SIZE
+
+# BBR states
+STARTUP = 'startup'
+DRAIN = 'drain'
+PROBE_BW = 'probe_bw'
+PROBE_RTT = 'probe_rtt'
+
+
+class BbrCongestionControl:
+    # BBR (v1) style congestion control. Instead of backing off on every loss, it keeps a model of the path: the
+    # bottleneck bandwidth (max delivery rate of the last 10 round trips) and the min RTT (of the last 10 seconds). The
+    # packets are paced at pacing_gain x bandwidth and the bytes in flight are capped at cwnd_gain x bandwidth-delay
+    # product:
+    #   startup: gain 2.885 until the bandwidth grows less than 25% for 3 round trips
+    #   drain: inverse gain until the queue created in startup is gone
+    #   probe_bw: pacing gain cycling through 1.25, 0.75 and 1 (x 6), each for one min RTT
+    #   probe_rtt: 4 packets in flight for 200 ms when the min RTT was not measured again for 10 seconds
+    #
+    # aioquic only passes the time to the RTT measurements and to the losses, so the acknowledged packets are accounted
+    # for on the next of those calls. As in BBR v1, losses only reduce the bytes in flight
+
+    def __init__(self):
+        self.bytes_in_flight = 0
+        self.congestion_window = K_INITIAL_WINDOW
+        self.ssthresh = None
+        self.pacing_rate = None  # bytes per second, None until the first bandwidth sample
+
+        self.state = STARTUP
+        self.pacing_gain = HIGH_GAIN
+        self.cwnd_gain = HIGH_GAIN
+        self.btl_bw = 0.0  # bytes per second
+        self.min_rtt = None
+        self.delivered = 0
+        self.lost = 0
+        self.round_count = 0
+
+        self._acked = []
+        self._bw_samples = deque()  # (round, rate), rates in decreasing order
+        self._min_rtt_stamp = 0.0
+        self._min_rtt_expired = False
+        self._delivered_time = 0.0
+        self._first_sent_time = 0.0
+        self._next_round_delivered = 0
+        self._round_start = False
+        self._full_bw = 0.0
+        self._full_bw_count = 0
+        self._filled_pipe = False
+        self._loss_in_cycle = False
+        self._cycle_index = 0
+        self._cycle_stamp = 0.0
+        self._prior_cwnd = 0
+        self._probe_rtt_done = None
+        self._probe_rtt_round = 0
+
+    def on_packet_sent(self, packet):
+        if self.bytes_in_flight == 0:
+            self._first_sent_time = self._delivered_time = packet.sent_time
+
+        # Delivery state when the packet was sent, for the delivery rate sample of its ack
+        packet.delivered = self.delivered
+        packet.delivered_time = self._delivered_time
+        packet.first_sent_time = self._first_sent_time
+        self.bytes_in_flight += packet.sent_bytes
+
+    def on_packet_acked(self, packet):
+        self.bytes_in_flight -= packet.sent_bytes
+        self._acked.append(packet)
+
+    def on_packets_expired(self, packets):
+        for packet in packets:
+            self.bytes_in_flight -= packet.sent_bytes
+
+    def on_packets_lost(self, packets, now):
+        for packet in packets:
+            self.bytes_in_flight -= packet.sent_bytes
+            self.lost += packet.sent_bytes
+            self._loss_in_cycle = True
+        self._update(now)
+
+    def on_rtt_measurement(self, latest_rtt, now):
+        self._min_rtt_expired = self.min_rtt is not None and now > self._min_rtt_stamp + MIN_RTT_WINDOW
+        if self.min_rtt is None or latest_rtt <= self.min_rtt or self._min_rtt_expired:
+            self.min_rtt = latest_rtt
+            self._min_rtt_stamp = now
+        self._update(now)
+
+    def _update(self, now):
+        acked_bytes = 0
+        self._round_start = False
+        if self._acked:
+            for packet in self._acked:
+                acked_bytes += packet.sent_bytes
+            self.delivered += acked_bytes
+            self._delivered_time = now
+            self._sample_bandwidth(max(self._acked, key=lambda acked: acked.delivered), now)
+            self._acked = []
+
+        self._update_state(now)
+        self._update_window(acked_bytes)
+        if self.btl_bw:
+            pacing_rate = self.pacing_gain * self.btl_bw
+            # The pacing rate only grows before the bandwidth is known
+            if self._filled_pipe or pacing_rate > (self.pacing_rate or 0):
+                self.pacing_rate = pacing_rate
+
+    def _sample_bandwidth(self, packet, now):
+        if packet.delivered >= self._next_round_delivered:
+            self._next_round_delivered = self.delivered
+            self.round_count += 1
+            self._round_start = True
+        self._first_sent_time = packet.sent_time
+
+        samples = self._bw_samples
+        interval = max(packet.sent_time - packet.first_sent_time, now - packet.delivered_time)
+        if interval > 0 and (self.min_rtt is None or interval >= self.min_rtt):
+            rate = (self.delivered - packet.delivered) / interval
+            while samples and samples[-1][1] <= rate:
+                samples.pop()
+            samples.append((self.round_count, rate))
+
+        while samples and samples[0][0] <= self.round_count - BTL_BW_ROUNDS:
+            samples.popleft()
+        if samples:
+            self.btl_bw = samples[0][1]
+
+    def _update_state(self, now):
+        if not self._filled_pipe and self._round_start:
+            if self.btl_bw >= self._full_bw * FULL_BW_GROWTH:
+                self._full_bw = self.btl_bw
+                self._full_bw_count = 0
+            else:
+                self._full_bw_count += 1
+                self._filled_pipe = self._full_bw_count >= FULL_BW_ROUNDS
+
+        if self.state == STARTUP and self._filled_pipe:
+            self.state = DRAIN
+            self.pacing_gain = 1 / HIGH_GAIN
+        if self.state == DRAIN and self.bytes_in_flight <= self._bdp():
+            self._enter_probe_bw(now)
+        if self.state == PROBE_BW:
+            self._advance_cycle(now)
+
+        if self.state != PROBE_RTT and self._min_rtt_expired:
+            self.state = PROBE_RTT
+            self.pacing_gain = 1
+            self.cwnd_gain = 1
+            self._prior_cwnd = self.congestion_window
+            self._probe_rtt_done = None
+        self._min_rtt_expired = False
+
+        if self.state == PROBE_RTT:
+            if self._probe_rtt_done is None:
+                if self.bytes_in_flight <= BBR_MINIMUM_WINDOW:
+                    self._probe_rtt_done = now + PROBE_RTT_DURATION
+                    self._probe_rtt_round = self.round_count
+            elif now >= self._probe_rtt_done and self.round_count > self._probe_rtt_round:
+                self._min_rtt_stamp = now
+                self.congestion_window = max(self.congestion_window, self._prior_cwnd)
+                if self._filled_pipe:
+                    self._enter_probe_bw(now)
+                else:
+                    self.state = STARTUP
+                    self.pacing_gain = HIGH_GAIN
+                    self.cwnd_gain = HIGH_GAIN
+
+    def _enter_probe_bw(self, now):
+        # Starts the cycle at a random phase other than the 0.75 one, so that flows do not probe together
+        self.state = PROBE_BW
+        self.cwnd_gain = PROBE_BW_CWND_GAIN
+        self._cycle_index = (random.randrange(len(PROBE_BW_GAINS) - 1) + 2) % len(PROBE_BW_GAINS)
+        self._start_cycle_phase(now)
+
+    def _advance_cycle(self, now):
+        full_length = now - self._cycle_stamp > (self.min_rtt or 0)
+        if self.pacing_gain > 1:
+            done = full_length and (self._loss_in_cycle or self.bytes_in_flight >= self.pacing_gain * self._bdp())
+        elif self.pacing_gain < 1:
+            done = full_length or self.bytes_in_flight <= self._bdp()
+        else:
+            done = full_length
+
+        if done:
+            self._cycle_index = (self._cycle_index + 1) % len(PROBE_BW_GAINS)
+            self._start_cycle_phase(now)
+
+    def _start_cycle_phase(self, now):
+        self.pacing_gain = PROBE_BW_GAINS[self._cycle_index]
+        self._cycle_stamp = now
+        self._loss_in_cycle = False
+
+    def _update_window(self, acked_bytes):
+        bdp = self._bdp()
+        target = max(int(self.cwnd_gain * bdp), BBR_MINIMUM_WINDOW) if bdp else K_INITIAL_WINDOW
+
+        if self._filled_pipe:
+            self.congestion_window = min(self.congestion_window + acked_bytes, target)
+        elif self.congestion_window < target or self.delivered < K_INITIAL_WINDOW:
+            self.congestion_window += acked_bytes
+        self.congestion_window = max(self.congestion_window, BBR_MINIMUM_WINDOW)
+
+        if self.state == PROBE_RTT:
+            self.congestion_window = min(self.congestion_window, BBR_MINIMUM_WINDOW)
+
+    def _bdp(self):
+        if self.min_rtt is None:
+            return 0
+        return self.btl_bw * self.min_rtt
+
+
+class ControlledPacer(QuicPacketPacer):
+    # Paces the packets at the pacing rate of the congestion controller instead of aioquic's congestion window per
+    # smoothed RTT, which is still used until the controller has a rate
+
+    def __init__(self, controller):
+        super().__init__()
+        self._controller = controller
+
+    def update_rate(self, congestion_window, smoothed_rtt):
+        pacing_rate = self._controller.pacing_rate
+        if pacing_rate is None:
+            super().update_rate(congestion_window, smoothed_rtt)
+            return
+
+        self.packet_time = max(K_MICRO_SECOND, min(K_MAX_DATAGRAM_SIZE / pacing_rate, K_SECOND))
+        self.bucket_max = max(2 * K_MAX_DATAGRAM_SIZE, min(congestion_window // 4, 16 * K_MAX_DATAGRAM_SIZE)) / \
+            pacing_rate
+        if self.bucket_time > self.bucket_max:
+            self.bucket_time = self.bucket_max
+
+
+# A controller implements the interface of aioquic's QuicCongestionControl (bytes_in_flight, congestion_window,
+# ssthresh and the on_* callbacks). One with a 'pacing_rate' attribute also sets the pacing of the connection
+CONGESTION_CONTROLS = {
+    RENO_CONTROL: QuicCongestionControl,
+    BBR_CONTROL: BbrCongestionControl,
+}
+
+
+def install_congestion_control(quic, name):
+    # Replaces the controller of a new aioquic connection, before it sends its first packet
+    recovery = quic._loss
+    controller = CONGESTION_CONTROLS[name]()
+    recovery._cc = controller
+    if hasattr(controller, 'pacing_rate'):
+        recovery._pacer = ControlledPacer(controller)
+    return controller
+
+
+def get_delivery_rate(quic):
+    # Estimated bytes per second the connection can deliver: the bottleneck bandwidth with BBR, otherwise the congestion
+    # window per smoothed RTT. None during slow start (BBR startup), while the estimate is only a lower bound
+    recovery = quic._loss
+    controller = recovery._cc
+    if isinstance(controller, BbrCongestionControl):
+        return controller.btl_bw if controller.state != STARTUP else None
+    if controller.ssthresh is None or not recovery._rtt_initialized:
+        return None
+    return controller.congestion_window / max(recovery._rtt_smoothed, K_MICRO_SECOND)
+
+
+def get_congestion_sample(quic):
+    # Current congestion window, RTTs (seconds) and pacing rate (bytes per second, None when not paced) of a connection
+    recovery = quic._loss
+    controller = recovery._cc
+    packet_time = recovery._pacer.packet_time
+
+    sample = {
+        'cwnd': controller.congestion_window,
+        'bytes_in_flight': controller.bytes_in_flight,
+        'smoothed_rtt': recovery._rtt_smoothed,
+        'min_rtt': recovery._rtt_min if recovery._rtt_min != math.inf else None,
+        'pacing_rate': K_MAX_DATAGRAM_SIZE / packet_time if packet_time else None,
+    }
+    if isinstance(controller, BbrCongestionControl):
+        sample['state'] = controller.state
+        sample['btl_bw'] = controller.btl_bw
+    return sample
@@ -0,0 +1,29 @@
+class ConnectionState:
+    # Server side. What the streams of a client connection share. The hp and lp streams put their requests in one
+    # queue, so a tile requested again on the other stream replaces its queued entry instead of being sent twice, and
+    # one push state and set of playback deadlines follow the whole session. A single sender takes the tiles from the
+    # queue and writes each one on the stream its request came on.
+    #
+    # 'writers' has the open streams, by stream id, and 'priority_streams' the stream of the last request of each
+    # priority, where the pushed tiles of that priority go
+
+    def __init__(self, client, connection_id, catalog, queue, push_state, deadlines):
+        self.client = client
+        self.connection_id = connection_id
+        self.catalog = catalog
+        self.queue = queue
+        self.push_state = push_state
+        self.deadlines = deadlines
+        self.writers = {}
+        self.priority_streams = {}
+
+        self.priority_bytes = {}
+        self.contended_bytes = {}
+        self.downgraded = 0
+
+    def writer(self, message):
+        # Writer of the stream the message goes on, None if the stream is already closed
+        stream_id = message.stream_id
+        if stream_id is None:
+            stream_id = self.priority_streams.get(message.priority, min(self.writers, default=None))
+        return self.writers.get(stream_id)
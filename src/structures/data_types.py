@@ -1,3 +1,33 @@
+import struct
+
+from src.constants.video_constants import BINARY_WIRE, LEGACY_WIRE, WIRE_VERSION, PUSH_CANCEL, PUSH_RECEIVED, \
+    PUSH_PROMISE, MAX_TILE, HIGH_PRIORITY, LOW_PRIORITY
+
+# Binary layouts (little-endian, fixed size). Every message starts with the wire version byte, which can never be
+# mistaken for the '[' that starts a legacy message
+VIDEO_PACKET_STRUCT = struct.Struct('<BHHBH')  # version, segment, tile, priority, bitrate
+QUIC_PACKET_STRUCT = struct.Struct('<BBBQHHBH')  # version, flags, push status, stream id, segment, tile, priority, bitrate
+
+# Segment requests carry one bit per tile (tile n is bit n-1): the requested tiles and the ones in the FOV
+TILE_BITMAP_SIZE = (MAX_TILE + 7) // 8
+SEGMENT_REQUEST_STRUCT = struct.Struct('<BBBQHH' + str(TILE_BITMAP_SIZE) + 's' + str(TILE_BITMAP_SIZE) + 's')
+
+# Tiles sent in DATAGRAM frames: each fragment starts with this header, and in the stream the tile header is followed by
+# DATAGRAM_TILE and the sequence number instead of the tile chunks
+TILE_FRAGMENT_STRUCT = struct.Struct('<BLHHHHH')  # version, sequence, fragment index, fragment count, segment, tile, bitrate
+DATAGRAM_TILE = 0xFFFFFFFF
+
+# Starts the hello, it can be mistaken for neither the wire version byte nor the '[' of a legacy message
+HELLO_MAGIC = b'HELO'
+
+END_STREAM_FLAG = 0x01
+VIDEO_PACKET_FLAG = 0x02
+SEGMENT_REQUEST_FLAG = 0x04
+CANCEL_FLAG = 0x08  # The tiles of the message are removed from the server queue instead of requested
+
+PUSH_STATUS_CODES = [None, PUSH_CANCEL, PUSH_RECEIVED, PUSH_PROMISE]
+
+
 class VideoPacket:
     def __init__(self, segment, tile, priority=2, bitrate=1):
         self.segment = segment
@@ -8,34 +38,167 @@ class VideoPacket:
     def get_list(self):
         return [self.segment, self.tile, self.priority, self.bitrate]
 
-    def serialize(self):
-        message = self.get_list()
-        return str(message).encode()
+    def serialize(self, wire_format=BINARY_WIRE):
+        if wire_format == LEGACY_WIRE:
+            message = self.get_list()
+            return str(message).encode()
+
+        return VIDEO_PACKET_STRUCT.pack(WIRE_VERSION, self.segment, self.tile, self.priority, int(self.bitrate))
+
+    @staticmethod
+    def deserialize(data):
+        version, segment, tile, priority, bitrate = VIDEO_PACKET_STRUCT.unpack(data)
+        check_wire_version(version)
+
+        return VideoPacket(segment=segment, tile=tile, priority=priority, bitrate=bitrate)
+
+
+class SegmentRequest:
+    def __init__(self, segment, bitrate, tiles, fov_tiles=()):
+        self.segment = segment
+        self.bitrate = bitrate
+        self.tiles_bitmap = tiles_to_bitmap(tiles)
+        self.fov_bitmap = tiles_to_bitmap(fov_tiles)
+
+    def get_tiles(self):
+        # (priority, tile, bitrate) of every requested tile, in tile order
+        return [(HIGH_PRIORITY if self.fov_bitmap >> (tile - 1) & 1 else LOW_PRIORITY, tile, self.bitrate)
+                for tile in bitmap_to_tiles(self.tiles_bitmap)]
 
 
 class QUICPacket:
-    def __init__(self, stream_id, end_stream, video_packet=None, push_status=None):
+    def __init__(self, stream_id, end_stream, video_packet=None, push_status=None, segment_request=None, cancel=False):
         self.stream_id = stream_id
         self.video_packet = video_packet
         self.end_stream = end_stream
         self.push_status = push_status
+        self.segment_request = segment_request
+        self.cancel = cancel
+
+    def serialize(self, wire_format=BINARY_WIRE):
+        if wire_format == LEGACY_WIRE:
+            if self.cancel:
+                raise ValueError("Cancel messages need the binary wire format")
+
+            message = [self.stream_id, self.end_stream]
+
+            if self.video_packet:
+                message += self.video_packet.get_list()
+
+            if self.push_status:
+                message += self.push_status
+
+            return str(message).encode()
 
-    def serialize(self):
-        message = [self.stream_id, self.end_stream]
+        flags = 0
+        if self.end_stream:
+            flags |= END_STREAM_FLAG
+        if self.cancel:
+            flags |= CANCEL_FLAG
 
+        if self.segment_request:
+            request = self.segment_request
+            return SEGMENT_REQUEST_STRUCT.pack(WIRE_VERSION, flags | SEGMENT_REQUEST_FLAG,
+                                               PUSH_STATUS_CODES.index(self.push_status), int(self.stream_id),
+                                               request.segment, int(request.bitrate),
+                                               request.tiles_bitmap.to_bytes(TILE_BITMAP_SIZE, 'little'),
+                                               request.fov_bitmap.to_bytes(TILE_BITMAP_SIZE, 'little'))
+
+        segment = tile = priority = bitrate = 0
         if self.video_packet:
-            message += self.video_packet.get_list()
+            flags |= VIDEO_PACKET_FLAG
+            segment, tile, priority, bitrate = self.video_packet.get_list()
+
+        return QUIC_PACKET_STRUCT.pack(WIRE_VERSION, flags, PUSH_STATUS_CODES.index(self.push_status),
+                                       int(self.stream_id), segment, tile, priority, int(bitrate))
+
+    @staticmethod
+    def deserialize(data):
+        if data[1] & SEGMENT_REQUEST_FLAG:
+            return QUICPacket.deserialize_segment_request(data)
+
+        version, flags, push_status, stream_id, segment, tile, priority, bitrate = QUIC_PACKET_STRUCT.unpack(data)
+        check_wire_version(version)
+
+        packet = QUICPacket(stream_id=str(stream_id), end_stream=bool(flags & END_STREAM_FLAG),
+                            push_status=PUSH_STATUS_CODES[push_status], cancel=bool(flags & CANCEL_FLAG))
+        if flags & VIDEO_PACKET_FLAG:
+            packet.video_packet = VideoPacket(segment=segment, tile=tile, priority=priority, bitrate=bitrate)
+
+        return packet
 
-        if self.push_status:
-            message += self.push_status
+    @staticmethod
+    def deserialize_segment_request(data):
+        version, flags, push_status, stream_id, segment, bitrate, tiles, fov_tiles = SEGMENT_REQUEST_STRUCT.unpack(data)
+        check_wire_version(version)
 
-        return str(message).encode()
+        request = SegmentRequest(segment=segment, bitrate=bitrate, tiles=())
+        request.tiles_bitmap = int.from_bytes(tiles, 'little')
+        request.fov_bitmap = int.from_bytes(fov_tiles, 'little')
+
+        return QUICPacket(stream_id=str(stream_id), end_stream=bool(flags & END_STREAM_FLAG),
+                          push_status=PUSH_STATUS_CODES[push_status], segment_request=request,
+                          cancel=bool(flags & CANCEL_FLAG))
 
 
 class VideoRequestMessage:
-    def __init__(self, message_type, segment, tile, bitrate):
+    def __init__(self, message_type, segment, tile, bitrate, priority=None):
         self.message_type = message_type
         self.segment = segment
         self.tile = tile
         self.bitrate = bitrate
+        self.priority = priority
+        self.queued_at = None  # time.monotonic() when it was queued, for the send latency metrics
+        self.size = 0  # bytes of the tile file
+        self.stream_id = None  # Stream the request came on, the tile is sent on it. None for pushed tiles
+
+
+def fragment_tile(sequence, segment, tile, bitrate, data, payload_size):
+    # Splits the tile in DATAGRAM frames of at most payload_size bytes
+    chunk_size = payload_size - TILE_FRAGMENT_STRUCT.size
+    count = max((len(data) + chunk_size - 1) // chunk_size, 1)
+    return [TILE_FRAGMENT_STRUCT.pack(WIRE_VERSION, sequence, index, count, segment, tile, int(bitrate)) +
+            data[index * chunk_size:(index + 1) * chunk_size]
+            for index in range(count)]
+
+
+def serialize_hello(client_id, video_id=None):
+    # First message of a connection, sent on its first stream only and framed like the others: HELLO_MAGIC, the client
+    # id, then the requested video id after a space
+    hello = str(client_id)
+    if video_id is not None:
+        hello += " " + video_id
+    return HELLO_MAGIC + hello.encode()
+
+
+def is_hello(data):
+    return data.startswith(HELLO_MAGIC)
+
+
+def deserialize_hello(data):
+    # (client id, video id or None). Clients from before the framed hello send their id alone, without HELLO_MAGIC
+    if is_hello(data):
+        data = data[len(HELLO_MAGIC):]
+    client_id, _, video_id = data.decode(errors='replace').partition(" ")
+    return client_id, video_id or None
+
+
+def check_wire_version(version):
+    if version != WIRE_VERSION:
+        raise ValueError("Unsupported wire version: " + str(version))
+
+
+def tiles_to_bitmap(tiles):
+    bitmap = 0
+    for tile in tiles:
+        bitmap |= 1 << (tile - 1)
+    return bitmap
+
 
+def bitmap_to_tiles(bitmap):
+    tiles = []
+    while bitmap:
+        lowest = bitmap & -bitmap
+        tiles.append(lowest.bit_length())
+        bitmap ^= lowest
+    return tiles
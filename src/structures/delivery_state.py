@@ -0,0 +1,85 @@
+import numpy as np
+
+from src.constants.video_constants import N_SEGMENTS, MAX_TILE
+
+# Delivery status flags of a tile
+REQUESTED = 0x01
+QUEUED = 0x02
+SENT = 0x04
+ACKED = 0x08
+
+
+class DeliveryState:
+    # Delivery status of every (segment, tile) of a connection: one byte of status flags per tile, plus the priority
+    # and bitrate of its last request, in (segments + 1) x (tiles + 1) arrays (row and column 0 are unused). The
+    # bitrate is stored per tile instead of as a third dimension, since a tile is only ever delivered at one bitrate.
+    # That is 4 bytes per tile, allocated once per connection, and the segment-wide queries are vectorized.
+    #
+    # Segments and tiles outside the video are ignored
+
+    def __init__(self, n_segments=N_SEGMENTS, max_tile=MAX_TILE):
+        shape = (n_segments + 1, max_tile + 1)
+        self.n_segments = n_segments
+        self.max_tile = max_tile
+        self.status = np.zeros(shape, dtype=np.uint8)
+        self.priority = np.zeros(shape, dtype=np.uint8)
+        self.bitrate = np.zeros(shape, dtype=np.uint16)
+
+    def request(self, segment, tiles):
+        # tiles: (priority, tile, bitrate) tuples
+        if not self._has_segment(segment) or not tiles:
+            return
+
+        priorities, tile_indexes, bitrates = self._columns(tiles)
+        self.status[segment, tile_indexes] |= REQUESTED
+        self.priority[segment, tile_indexes] = priorities
+        self.bitrate[segment, tile_indexes] = bitrates
+
+    def set(self, segment, tiles, flag):
+        if self._has_segment(segment):
+            self.status[segment, self._tile_indexes(tiles)] |= flag
+
+    def clear(self, segment, tiles, flag):
+        if self._has_segment(segment):
+            self.status[segment, self._tile_indexes(tiles)] &= ~flag & 0xFF
+
+    def has(self, segment, tile, flag):
+        return self._has_segment(segment) and 0 < tile <= self.max_tile and bool(self.status[segment, tile] & flag)
+
+    def count(self, segment, flag):
+        if not self._has_segment(segment):
+            return 0
+        return int(np.count_nonzero(self.status[segment] & flag))
+
+    def missing(self, segment):
+        # Tiles requested but not sent yet
+        if not self._has_segment(segment):
+            return []
+        row = self.status[segment]
+        return np.flatnonzero(((row & REQUESTED) != 0) & ((row & SENT) == 0)).tolist()
+
+    def push_set(self, template, segment):
+        # Tiles of 'segment' to push, as (priority, tile, bitrate): the ones requested in 'template', with the same
+        # priorities and bitrates, that were not requested, queued or sent for 'segment'. Ordered by priority, then tile
+        if not self._has_segment(template) or not self._has_segment(segment):
+            return []
+
+        wanted = (self.status[template] & REQUESTED) != 0
+        wanted &= (self.status[segment] & (REQUESTED | QUEUED | SENT)) == 0
+        tiles = np.flatnonzero(wanted)
+        priorities = self.priority[template, tiles]
+        tiles = tiles[np.argsort(priorities, kind='stable')]
+
+        return list(zip(self.priority[template, tiles].tolist(), tiles.tolist(), self.bitrate[template, tiles].tolist()))
+
+    def _has_segment(self, segment):
+        return 0 < segment <= self.n_segments
+
+    def _tile_indexes(self, tiles):
+        tile_indexes = np.fromiter(tiles, dtype=np.int64)
+        return tile_indexes[(tile_indexes > 0) & (tile_indexes <= self.max_tile)]
+
+    def _columns(self, tiles):
+        columns = np.array(tiles, dtype=np.int64).reshape(-1, 3)
+        columns = columns[(columns[:, 1] > 0) & (columns[:, 1] <= self.max_tile)]
+        return columns[:, 0], columns[:, 1], columns[:, 2]
@@ -0,0 +1,70 @@
+import asyncio
+from collections import OrderedDict, deque
+
+
+class EgressScheduler:
+    # Server-wide scheduler shared by every connection.
+    #
+    # Each connection still picks its next tile from its own queue (FIFO, SP or WFQ), so the FOV/non-FOV priority is
+    # applied within the client. Before writing it, the connection asks for a transmission grant here. Grants are given
+    # with Deficit Round Robin across clients: on each round a client earns 'quantum' bytes of credit and is granted
+    # its pending tiles while the credit covers them. With an egress rate the scheduler waits for the granted bytes to
+    # leave at that rate before the next grant, so the link capacity is shared fairly between clients
+
+    def __init__(self, quantum, rate=0):
+        self.quantum = quantum
+        self.rate = rate  # bytes per second, 0 for no limit
+        self.bytes_granted = {}
+
+        self._flows = OrderedDict()  # client -> deque of (cost, future), only clients waiting for a grant
+        self._deficit = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def transmit(self, client, cost):
+        future = asyncio.get_event_loop().create_future()
+
+        if client not in self._flows:
+            self._flows[client] = deque()
+        self._flows[client].append((cost, future))
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+
+        await future
+
+    def remove_client(self, client):
+        self._deficit.pop(client, None)
+        return self.bytes_granted.pop(client, 0)
+
+    async def _run(self):
+        while True:
+            if not self._flows:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            client, flow = next(iter(self._flows.items()))
+            deficit = self._deficit.get(client, 0) + self.quantum
+
+            while flow and flow[0][0] <= deficit:
+                cost, future = flow.popleft()
+                deficit -= cost
+                if future.cancelled():
+                    continue
+
+                future.set_result(None)
+                self.bytes_granted[client] = self.bytes_granted.get(client, 0) + cost
+
+                if self.rate > 0:
+                    await asyncio.sleep(cost / self.rate)
+
+            if flow:
+                self._deficit[client] = deficit
+                self._flows.move_to_end(client)
+            else:
+                self._deficit[client] = 0
+                del self._flows[client]
+
+            await asyncio.sleep(0)
@@ -0,0 +1,98 @@
+import json
+import logging
+import sys
+import threading
+import time
+from collections import deque
+
+
+class EventLogger:
+    # Structured events written as JSON lines ({"ts", "level", "event", ...fields}). log() only appends the event to
+    # an in-memory buffer; a background thread writes the buffered events in batches, so the event loop never waits on
+    # the output. Events below 'level' are discarded before being built, and an event with a sample rate N is kept once
+    # every N times. When more than 'max_pending' events are waiting the new ones are dropped and counted.
+    #
+    # Without an output file the events go to stderr, keeping stdout for the summaries parsed by the scripts. Levels
+    # are the ones of the logging module
+
+    def __init__(self, output=None, level=logging.INFO, sample_rates=None, flush_interval=0.5, max_pending=100000):
+        self.level = level
+        self.sample_rates = sample_rates or {}
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+
+        self._output = output
+        self._file = sys.stderr if output is None else open(output, "a", encoding="utf-8")
+        self._pending = deque()
+        self._sample_counts = {}
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="event-logger", daemon=True)
+        self._thread.start()
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, event, **fields):
+        if level < self.level:
+            return
+
+        rate = self.sample_rates.get(event)
+        if rate:
+            count = self._sample_counts.get(event, 0)
+            self._sample_counts[event] = count + 1
+            if count % rate:
+                return
+
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+
+        fields['ts'] = time.time()
+        fields['level'] = logging.getLevelName(level)
+        fields['event'] = event
+        self._pending.append(fields)
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        if self._output is not None:
+            self._file.close()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        lines = []
+        while self._pending:
+            lines.append(json.dumps(self._pending.popleft(), separators=(',', ':'), default=str))
+
+        if lines:
+            self._file.write("\n".join(lines) + "\n")
+            self._file.flush()
+
+
+def parse_sample_rates(text):
+    # "event=N,event=N" -> {event: N}
+    sample_rates = {}
+    for item in filter(None, (item.strip() for item in text.split(","))):
+        event, _, rate = item.partition("=")
+        if not rate.isdigit() or int(rate) < 1:
+            raise ValueError("Invalid sample rate: " + item)
+        sample_rates[event] = int(rate)
+    return sample_rates
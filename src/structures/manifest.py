@@ -0,0 +1,96 @@
+import math
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+NUMBER = r'(\d+(?:\.\d+)?)'
+DURATION_PATTERN = re.compile('P(?:' + NUMBER + 'D)?(?:T(?:' + NUMBER + 'H)?(?:' + NUMBER + 'M)?(?:' + NUMBER +
+                              'S)?)?$')
+TEMPLATE_PATTERN = re.compile(r'\$(RepresentationID|Number|Bandwidth)(?:%0(\d+)d)?\$|\$\$')
+
+
+class Manifest:
+    # One MPD of the tiled video, as written by MP4Box in setup.py: one encoding bitrate, with a Representation per
+    # tile. Tiles are numbered in the order of their Representations, from 1. 'files' has the media file path of every
+    # segment of every tile (files[tile - 1][segment - 1]), resolved from the SegmentTemplate relative to the MPD
+    #
+    # Only SegmentTemplate addressing is supported, with either a fixed segment duration or a SegmentTimeline
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.files = []
+
+        try:
+            root = ElementTree.parse(file_name).getroot()
+        except ElementTree.ParseError as err:
+            raise ValueError(file_name + ": " + str(err))
+        namespace = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+        period = root.find(namespace + 'Period')
+        if period is None:
+            raise ValueError("No Period in " + file_name)
+
+        duration = parse_duration(root.get('mediaPresentationDuration') or period.get('duration'))
+        folder = os.path.dirname(file_name)
+        self.bandwidth = 0
+
+        for adaptation_set in period.findall(namespace + 'AdaptationSet'):
+            set_template = adaptation_set.find(namespace + 'SegmentTemplate')
+            for representation in adaptation_set.findall(namespace + 'Representation'):
+                template = representation.find(namespace + 'SegmentTemplate')
+                if template is None:
+                    template = set_template
+                if template is None or template.get('media') is None:
+                    raise ValueError("Representation without a SegmentTemplate in " + file_name)
+
+                bandwidth = int(representation.get('bandwidth', 0))
+                self.bandwidth += bandwidth
+                numbers = segment_numbers(template, namespace, duration)
+                self.files.append([os.path.join(folder, expand_template(template.get('media'),
+                                                                        representation.get('id', ''), number,
+                                                                        bandwidth))
+                                   for number in numbers])
+
+        if not self.files:
+            raise ValueError("No Representations in " + file_name)
+
+        self.n_segments = max(len(segments) for segments in self.files)
+        self.max_tile = len(self.files)
+
+    def file(self, segment, tile):
+        segments = self.files[tile - 1] if 1 <= tile <= self.max_tile else []
+        return segments[segment - 1] if 1 <= segment <= len(segments) else None
+
+
+def parse_duration(text):
+    # ISO 8601 duration (PT0H1M0.000S) in seconds
+    match = DURATION_PATTERN.match(text or '')
+    if not text or match is None:
+        raise ValueError("Invalid duration: " + str(text))
+
+    days, hours, minutes, seconds = (float(value) if value else 0 for value in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def segment_numbers(template, namespace, duration):
+    start_number = int(template.get('startNumber', 1))
+
+    timeline = template.find(namespace + 'SegmentTimeline')
+    if timeline is not None:
+        count = sum(1 + int(entry.get('r', 0)) for entry in timeline.findall(namespace + 'S'))
+    else:
+        segment_duration = int(template.get('duration', 0)) / int(template.get('timescale', 1))
+        if segment_duration <= 0:
+            raise ValueError("SegmentTemplate without a duration or a SegmentTimeline")
+        count = math.ceil(round(duration / segment_duration, 6))
+
+    return range(start_number, start_number + count)
+
+
+def expand_template(media, representation_id, number, bandwidth):
+    def replace(match):
+        if match.group(0) == '$$':
+            return '$'
+        value = {'RepresentationID': representation_id, 'Number': number, 'Bandwidth': bandwidth}[match.group(1)]
+        return str(value).zfill(int(match.group(2))) if match.group(2) else str(value)
+
+    return TEMPLATE_PATTERN.sub(replace, media)
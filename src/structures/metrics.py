@@ -0,0 +1,104 @@
+import bisect
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class MetricsRegistry:
+    # In-process metrics, rendered in the Prometheus text format (version 0.0.4). Samples are keyed by their sorted
+    # label pairs. Collectors are called on every render, for values that are cheaper to read when scraped (e.g. queue
+    # depths) than to keep up to date on every change
+
+    def __init__(self):
+        self._metrics = {}  # name -> (type, help)
+        self._samples = {}  # name -> {labels: value}, histograms: {labels: [bucket counts, sum, count]}
+        self._buckets = {}  # histogram name -> upper bounds
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        self._register(name, COUNTER, help_text)
+
+    def gauge(self, name, help_text):
+        self._register(name, GAUGE, help_text)
+
+    def histogram(self, name, help_text, buckets):
+        self._register(name, HISTOGRAM, help_text)
+        self._buckets[name] = sorted(buckets)
+
+    def add_collector(self, collector):
+        # collector() returns (name, labels dict, value) gauge samples
+        self._collectors.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        samples = self._samples[name]
+        key = _label_key(labels)
+        samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self._samples[name][_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        samples = self._samples[name]
+        key = _label_key(labels)
+        sample = samples.get(key)
+        if sample is None:
+            sample = samples[key] = [[0] * len(self._buckets[name]), 0.0, 0]
+
+        index = bisect.bisect_left(self._buckets[name], value)
+        if index < len(sample[0]):
+            sample[0][index] += 1
+        sample[1] += value
+        sample[2] += 1
+
+    def render(self):
+        collected = {}
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                collected.setdefault(name, {})[_label_key(labels)] = value
+
+        lines = []
+        for name, (metric_type, help_text) in self._metrics.items():
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+
+            samples = dict(self._samples[name])
+            samples.update(collected.get(name, {}))
+
+            for key, value in samples.items():
+                if metric_type != HISTOGRAM:
+                    lines.append(name + _format_labels(key) + " " + _format_value(value))
+                    continue
+
+                bucket_counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self._buckets[name], bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(name + "_bucket" + _format_labels(key + (('le', _format_value(bound)),)) + " " +
+                                 str(cumulative))
+                lines.append(name + "_bucket" + _format_labels(key + (('le', '+Inf'),)) + " " + str(count))
+                lines.append(name + "_sum" + _format_labels(key) + " " + _format_value(total))
+                lines.append(name + "_count" + _format_labels(key) + " " + str(count))
+
+        return "\n".join(lines) + "\n"
+
+    def _register(self, name, metric_type, help_text):
+        self._metrics[name] = (metric_type, help_text)
+        self._samples.setdefault(name, {})
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return "{" + ",".join(label + '="' + value + '"' for (label, _), value in zip(key, escaped)) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,149 @@
+import asyncio
+
+import numpy as np
+
+from src.constants.video_constants import N_SEGMENTS, MAX_TILE
+
+
+class PlaybackBuffer:
+    # Client side. What the client knows about every (segment, tile): the bitrate it was received at (0 if it was not),
+    # its bytes, when it arrived (NaN if it did not), the time spent downloading it, the bitrate it was requested at
+    # (0 if it was not) and whether it was lost (sent in datagrams that never completed). The arrays are indexed by the
+    # segment and tile numbers, row and column 0 are unused. The player, the ABR inputs and the client metrics all read
+    # them from here.
+    #
+    # Each segment has two futures, resolved as the tiles come in: complete(), once all of its tiles are in, and
+    # fov_complete(), once the tiles of its FOV are. The buffering and the player await them instead of polling the
+    # tiles. A segment without a FOV needs all of its tiles. A lost tile is not received, but it still counts as in, so
+    # nothing waits for it and it is not requested again
+
+    def __init__(self, n_segments=N_SEGMENTS, tiles=range(1, MAX_TILE)):
+        self.n_segments = n_segments
+        self.tiles = list(tiles)
+        self.tiles_downgraded = 0  # Received below the requested bitrate
+        self.bytes_received = 0
+
+        shape = (n_segments + 1, max(self.tiles) + 1)
+        self.bitrate = np.zeros(shape, dtype=np.uint16)
+        self.size = np.zeros(shape, dtype=np.uint32)
+        self.arrival = np.full(shape, np.nan)
+        self.download_time = np.zeros(shape)
+        self.lost = np.zeros(shape, dtype=bool)
+        self.fov = np.zeros(shape, dtype=bool)
+        self.requested_bitrate = np.zeros(shape, dtype=np.uint16)
+
+        self._tile_index = np.array(self.tiles)
+        self._columns = np.zeros(shape[1], dtype=bool)
+        self._columns[self.tiles] = True
+        self._has_fov = np.zeros(n_segments + 1, dtype=bool)
+        self._missing = np.full(n_segments + 1, len(self.tiles))
+        self._fov_missing = np.zeros(n_segments + 1, dtype=int)
+        self._complete = {}
+        self._fov_complete = {}
+
+    def request(self, segment, bitrate, tiles):
+        # A tile requested again keeps the lowest of its requested bitrates: the answer to the earlier request may still
+        # be on its way, and it is not a downgrade
+        if not 1 <= segment <= self.n_segments:
+            return
+
+        tiles = [tile for tile in tiles if 0 <= tile < len(self._columns) and self._columns[tile]]
+        requested = self.requested_bitrate[segment, tiles]
+        self.requested_bitrate[segment, tiles] = np.where(requested > 0, np.minimum(requested, bitrate), bitrate)
+
+    def add(self, segment, tile, bitrate, size, download_time):
+        # A tile received again (e.g. at the highest bitrate when the buffer is filled) replaces the first one, and
+        # adds to its download time
+        if not self._is_tile(segment, tile):
+            return
+
+        self.bytes_received += size
+        self.download_time[segment, tile] += download_time
+        if int(bitrate) < self.requested_bitrate[segment, tile]:
+            self.tiles_downgraded += 1
+
+        is_new = not self._is_in(segment, tile)
+        self.bitrate[segment, tile] = bitrate
+        self.size[segment, tile] = size
+        self.arrival[segment, tile] = asyncio.get_event_loop().time()
+        if is_new:
+            self._tile_in(segment, tile)
+
+    def lose(self, segment, tile):
+        if self._is_tile(segment, tile) and not self._is_in(segment, tile):
+            self.lost[segment, tile] = True
+            self._tile_in(segment, tile)
+
+    def set_fov(self, segment, fov):
+        if not 1 <= segment <= self.n_segments:
+            return
+
+        self.fov[segment] = False
+        self.fov[segment, [tile for tile in fov if 0 <= tile < len(self._columns)]] = True
+        self.fov[segment] &= self._columns
+        self._has_fov[segment] = True
+        self._fov_missing[segment] = np.count_nonzero(self.fov[segment] & ~self._in_row(segment))
+        if segment in self._fov_complete:
+            self._resolve(self._fov_complete, segment, self.is_fov_complete(segment))
+
+    def missing(self, segment):
+        return np.flatnonzero(self._columns & ~self._in_row(segment)).tolist()
+
+    def missing_mask(self, segment):
+        # Tiles not received (lost ones included), in the order of 'tiles'
+        return self.bitrate[segment, self._tile_index] == 0
+
+    def is_complete(self, segment):
+        return self._missing[segment] == 0
+
+    def is_fov_complete(self, segment):
+        return self._fov_missing[segment] == 0 if self._has_fov[segment] else self._missing[segment] == 0
+
+    def buffered_seconds(self, segment, segment_duration):
+        # Seconds of video ready to play from 'segment', up to the first segment that is not complete
+        incomplete = np.flatnonzero(self._missing[segment:] > 0)
+        segments = incomplete[0] if len(incomplete) else self.n_segments + 1 - segment
+        return segments * segment_duration
+
+    def segment_download_time(self, segment):
+        # Time spent downloading the segment's tiles, None if none was received
+        received = self.bitrate[segment] > 0
+        return float(self.download_time[segment, received].sum()) if received.any() else None
+
+    def total_download_time(self):
+        return float(self.download_time.sum())
+
+    def complete(self, segment):
+        return self._resolve(self._complete, segment, self.is_complete(segment))
+
+    def fov_complete(self, segment):
+        return self._resolve(self._fov_complete, segment, self.is_fov_complete(segment))
+
+    def _is_tile(self, segment, tile):
+        return 1 <= segment <= self.n_segments and 0 <= tile < len(self._columns) and self._columns[tile]
+
+    def _is_in(self, segment, tile):
+        return self.bitrate[segment, tile] > 0 or self.lost[segment, tile]
+
+    def _in_row(self, segment):
+        return (self.bitrate[segment] > 0) | self.lost[segment]
+
+    def _tile_in(self, segment, tile):
+        self._missing[segment] -= 1
+        if self.fov[segment, tile]:
+            self._fov_missing[segment] -= 1
+
+        # Only the futures somebody asked for exist
+        if segment in self._complete:
+            self._resolve(self._complete, segment, self.is_complete(segment))
+        if segment in self._fov_complete:
+            self._resolve(self._fov_complete, segment, self.is_fov_complete(segment))
+
+    @staticmethod
+    def _resolve(futures, segment, is_done):
+        future = futures.get(segment)
+        if future is None:
+            future = futures[segment] = asyncio.get_event_loop().create_future()
+        if is_done and not future.done():
+            future.set_result(segment)
+        return future
@@ -0,0 +1,88 @@
+import asyncio
+
+from src.constants.video_constants import N_SEGMENTS, MAX_TILE, INITIAL_BUFFER_SIZE
+from src.structures.delivery_state import DeliveryState, REQUESTED, QUEUED, SENT, ACKED
+
+
+class PushState:
+    # Per-connection server push state, shared by the request reader and the push scheduler. The scheduler sleeps on
+    # 'wakeup', which is set when a segment is requested, when the connection queue drains and when the connection
+    # closes.
+    #
+    # What was requested, queued, sent and acknowledged is kept in 'delivery'. The tiles of the last segment the client
+    # started requesting ('template') are pushed for the following segments. 'n_segments' and 'max_tile' are the ones of
+    # the video the client watches. 'segment_tiles' is the most tiles the client requested for a segment, the ones of a
+    # whole segment request, which the clients split between their streams
+
+    def __init__(self, is_push_allowed, event_log, client=None, n_segments=N_SEGMENTS, max_tile=MAX_TILE):
+        self.is_push_allowed = is_push_allowed
+        self.event_log = event_log
+        self.client = client
+        self.is_pushing = False
+        self.closed = False
+        self.segment = 1
+        self.last_segment = 1
+        self.template = 1
+        self.request_size = 0
+        self.segment_tiles = 0
+        self.delivery = DeliveryState(n_segments, max_tile)
+        self.push_tiles = []  # Tiles of the segment being pushed, the next one last
+        self.wakeup = asyncio.Event()
+
+    def requested(self, segment, tiles, is_tile_request):
+        self.segment = segment
+        self.is_pushing = False
+
+        if segment != self.last_segment and segment <= self.delivery.n_segments:
+            if self.delivery.count(segment, REQUESTED):
+                self.event_log.info("missing_tiles_requested", client=self.client, segment=segment)
+            else:
+                self.last_segment = segment
+                self.template = segment
+                if is_tile_request:
+                    self.event_log.info("segment_started", client=self.client, segment=segment)
+
+        self.delivery.request(segment, tiles)
+        self.segment_tiles = max(self.segment_tiles, self.delivery.count(segment, REQUESTED))
+        self.delivery.set(segment, [tile for _, tile, _ in tiles], QUEUED)
+        self.wakeup.set()
+
+    def cancelled(self, segment, tiles):
+        self.delivery.clear(segment, [tile for _, tile, _ in tiles], QUEUED)
+
+    def acknowledged(self, segment, tiles):
+        self.delivery.set(segment, [tile for _, tile, _ in tiles], ACKED)
+
+    def sent(self, segment, tile):
+        self.delivery.set(segment, [tile], SENT)
+        self.delivery.clear(segment, [tile], QUEUED)
+
+    def next_push_tile(self):
+        # The tiles of the next segment are pushed with the same priorities and bitrates the client used for the
+        # template segment, once the client requested as many of its tiles as in a whole segment request
+        if INITIAL_BUFFER_SIZE <= self.segment <= self.delivery.n_segments - 1 and self.segment == self.last_segment \
+                and self.delivery.count(self.template, REQUESTED) == self.segment_tiles:
+            self.segment += 1
+            self.push_tiles = self.delivery.push_set(self.template, self.segment)[::-1]
+            self.event_log.info("segment_pushed", client=self.client, segment=self.segment)
+            self.is_pushing = True
+
+        tile = None
+        while self.is_pushing and self.push_tiles and tile is None:
+            tile = self.push_tiles.pop()
+            if self.delivery.has(self.segment, tile[1], REQUESTED | QUEUED | SENT):
+                tile = None  # Requested by the client in the meantime
+
+        if self.is_pushing and not self.push_tiles:
+            self.last_segment += 1
+            if self.segment >= self.delivery.n_segments:
+                self.is_pushing = False
+
+        if tile is not None:
+            self.delivery.set(self.segment, [tile[1]], QUEUED)
+
+        return tile
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
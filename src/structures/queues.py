@@ -1,22 +1,166 @@
 from asyncio import Queue
-import heapq
+import itertools
+import time
 
+from src.constants.video_constants import WFQ_WEIGHTS, PUSH_REQUEST
 
-class StrictPriorityQueue(Queue):
-    def _init(self, maxsize):
-        self._queue = []
 
-    def _put(self, item, heappush=heapq.heappush):
-        heappush(self._queue, item)
+class KeyedQueue(Queue):
 
-    def _get(self, heappop=heapq.heappop):
-        return heappop(self._queue)[1]
+    # Base of the connection queues. Entries are keyed by the (segment, tile) of their VideoRequestMessage and the heap
+    # keeps the position of each key, so a new request for a queued tile replaces the entry in place, moving it up or
+    # down the heap (decrease/increase-key), and cancel() removes it, both in O(log n). A push never replaces a queued
+    # request. Control messages (tile 0) are never merged.
+    #
+    # Subclasses order the heap through the sort key they give to _push() and are told about removed entries through
+    # _removed(). Each sort key is unique (it ends with a counter), so the contents are never compared.
+    #
+    # queued_bytes is the sum of the tile sizes of the queued messages
+
+    def _init(self, maxsize):
+        self._queue = []  # Heap of [sort key, key, content, extra]
+        self._position = {}  # key -> index of its entry in the heap
+        self._counter = itertools.count()
+        self.superseded = 0  # Queued entries replaced by a new request
+        self.cancelled = 0
+        self.queued_bytes = 0
 
     def get_queue_size(self):
         return len(self._queue)
 
+    def get_depth(self):
+        # Queued entries of each priority
+        depth = {}
+        for entry in self._queue:
+            priority = entry[2].priority
+            depth[priority] = depth.get(priority, 0) + 1
+        return depth
+
+    def cancel(self, segment, tile):
+        index = self._position.get((segment, tile))
+        if index is None:
+            return False
+
+        entry = self._remove(index)
+        self._removed(entry)
+        self.cancelled += 1
+        return True
+
+    def _lookup(self, content):
+        index = self._position.get(self._key(content))
+        return None if index is None else self._queue[index]
+
+    def _push(self, sort_key, content, extra=None):
+        key = self._key(content)
+        index = self._position.get(key) if key is not None else None
+
+        if index is None:
+            entry = [sort_key, key, content, extra]
+            self._queue.append(entry)
+            self._set(len(self._queue) - 1, entry)
+            self._sift_up(len(self._queue) - 1)
+            self.queued_bytes += content.size
+            return
+
+        entry = self._queue[index]
+        if content.message_type == PUSH_REQUEST and entry[2].message_type != PUSH_REQUEST:
+            return
+
+        self.queued_bytes += content.size - entry[2].size
+        entry[0], entry[2], entry[3] = sort_key, content, extra
+        self.superseded += 1
+        self._sift_down(self._sift_up(index))
+
+    def _pop(self):
+        return self._remove(0)
+
+    def _removed(self, entry):
+        pass
+
+    @staticmethod
+    def _key(content):
+        if not content.tile:
+            return None
+        return content.segment, content.tile
+
+    def _remove(self, index):
+        queue = self._queue
+        entry = queue[index]
+        last = queue.pop()
+        if entry[1] is not None:
+            del self._position[entry[1]]
+        self.queued_bytes -= entry[2].size
+
+        if index < len(queue):
+            self._set(index, last)
+            self._sift_down(self._sift_up(index))
+
+        return entry
+
+    def _set(self, index, entry):
+        self._queue[index] = entry
+        if entry[1] is not None:
+            self._position[entry[1]] = index
+
+    def _sift_up(self, index):
+        queue = self._queue
+        entry = queue[index]
+        while index > 0:
+            parent = (index - 1) >> 1
+            if not entry[0] < queue[parent][0]:
+                break
+            self._set(index, queue[parent])
+            index = parent
+
+        self._set(index, entry)
+        return index
+
+    def _sift_down(self, index):
+        queue = self._queue
+        size = len(queue)
+        entry = queue[index]
+        while True:
+            child = 2 * index + 1
+            if child >= size:
+                break
+            if child + 1 < size and queue[child + 1][0] < queue[child][0]:
+                child += 1
+            if not queue[child][0] < entry[0]:
+                break
+            self._set(index, queue[child])
+            index = child
+
+        self._set(index, entry)
+        return index
+
+
+class FifoQueue(KeyedQueue):
+
+    # Arrival order. A re-request keeps the position of the queued entry and updates its priority and bitrate
+
+    def _put(self, item):
+        entry = self._lookup(item)
+        self._push(entry[0] if entry else next(self._counter), item)
+
+    def _get(self):
+        return self._pop()[2]
+
+
+class StrictPriorityQueue(KeyedQueue):
+
+    # Items are (priority, content). Arrival order within a priority, a re-request moves the entry to its new
+    # priority keeping its arrival order
+
+    def _put(self, item):
+        priority, content = item
+        entry = self._lookup(content)
+        self._push((priority, entry[0][1] if entry else next(self._counter)), content)
 
-class WeightedFairQueue(Queue):
+    def _get(self):
+        return self._pop()[2]
+
+
+class WeightedFairQueue(KeyedQueue):
 
     # Source: http://www.csun.edu/ansr/resources/simul15_paper.pdf
     #
@@ -24,89 +168,136 @@ class WeightedFairQueue(Queue):
     # nonempty queue sends b ∗ t ∗ w bits, with 'w' being the share of the bandwidth that the link has.
     # To simulate GPS, the WFQ method calculates the order in which the last bit of each packet would be sent by a GPS
     # scheduler and dequeues the packets in that order
+    #
+    # The virtual time is self-clocked (SCFQ): it is the finish time of the last dequeued packet, instead of a GPS
+    # simulation over the active classes. Each class only keeps its last finish time, so the state does not grow with
+    # the session, and every operation is a single heap push or pop, O(log n) on the number of queued packets.
+    #
+    # Items are (priority, length, content). Priority p goes to class p-1; priorities outside the configured classes
+    # (e.g. HIGHEST_PRIORITY control messages) go to the last class. A re-request with the same class and length keeps
+    # its finish time, otherwise the packet gets a new finish time in its new class
+
+    def __init__(self, maxsize=0, weights=WFQ_WEIGHTS):
+        self.weight = check_weights(weights)
+        super().__init__(maxsize)
 
     def _init(self, maxsize):
-        self.n = 2  # Number of different priorities (for now we have in FOV, and out of FOV)
-        self._queue = []
-        self.active = [False, False]
-        self.weight = [0.75, 0.25]  # Share of the bandwidth for each queue
-        self.ST = [[],[]] # Start time queues
-        self.FT = [[], []] # Finish time queues
-        self.VT = 0 # Virtual time
-        self.time = 0
-        self.last_time = 0
-        self.last_VT = 0
-
-    def _put(self, item, heappush=heapq.heappush):
-        priority = item[0]-1
-        length = item[1]
-        content = item[2]
-
-        self.update_virtual_time(length)
-
-        self.activate(priority)
-
-        if len(self.FT[priority]) == 0:
-            ST = 0
-        else:
-            ST = max(self.FT[priority][-1], self.VT)
-
-        finish_time = ST + length/self.weight[priority]
-        self.FT[priority].append(finish_time)
-        new_item = (finish_time, content)
-
-        heappush(self._queue, new_item)
-
-    def _get(self, heappop=heapq.heappop):
-        return heappop(self._queue)[1]
-
-    def get_active_min_f(self):
-        try:
-            first_active = self.active.index(True)
-        except ValueError:
-            return -1
-
-        minimum = self.FT[first_active][-1]
-        index = first_active
-        for i in range(first_active + 1, self.n):
-            if self.active[i] and self.FT[i][-1] < minimum:
-                minimum = self.FT[i][-1]
-                index = i
+        super()._init(maxsize)
+        self.n = len(self.weight)  # Number of priority classes
+        self.last_finish = [0.0] * self.n  # Finish time of the last packet of each class
+        self.virtual_time = 0.0
+        self.backlog = [0] * self.n  # Queued packets of each class
+        self.contended = False  # Whether the last packet was dequeued while more than one class was queued
+
+    def set_weights(self, weights):
+        # New weights apply to the packets enqueued from now on
+        weights = check_weights(weights)
+        if any(self.backlog[len(weights):]):
+            raise ValueError("Cannot remove priority classes that still have queued packets")
+
+        self.weight = weights
+        self.n = len(weights)
+        self.last_finish = (self.last_finish + [0.0] * self.n)[:self.n]
+        self.backlog = (self.backlog + [0] * self.n)[:self.n]
+
+    def _put(self, item):
+        priority, length, content = item
+        index = priority - 1 if 1 <= priority <= self.n else self.n - 1
+
+        entry = self._lookup(content)
+        if entry is not None and entry[3] == (index, length):
+            self._push(entry[0], content, entry[3])
+            return
+
+        if entry is not None:
+            if content.message_type == PUSH_REQUEST and entry[2].message_type != PUSH_REQUEST:
+                return
+            self._removed(entry)
+
+        start_time = max(self.virtual_time, self.last_finish[index])
+        finish_time = start_time + length / self.weight[index]
+        self.last_finish[index] = finish_time
+        self.backlog[index] += 1
+
+        self._push((finish_time, next(self._counter)), content, (index, length))
+
+    def _get(self):
+        (finish_time, _), _, content, (index, _) = self._pop()
+        self.contended = sum(1 for count in self.backlog if count > 0) > 1
+        self.backlog[index] -= 1
+        self.virtual_time = finish_time
+        return content
+
+    def _removed(self, entry):
+        index = entry[3][0]
+        if index < self.n:
+            self.backlog[index] -= 1
+
+
+class EarliestDeadlineQueue(KeyedQueue):
+
+    # Items are (priority, deadline, length, content). Lower priorities are served first and, within a priority, the
+    # earliest deadline. Entries whose deadline already passed are dropped when they reach the head of the queue, since
+    # the client has played that segment already; their count and bytes are kept in 'dropped' and 'dropped_bytes'.
+    # A deadline of None never expires (control messages).
+    #
+    # If every queued entry expired, get() returns None
+
+    def __init__(self, maxsize=0, clock=time.monotonic):
+        self.clock = clock
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    def _put(self, item):
+        priority, deadline, length, content = item
+        entry = self._lookup(content)
+        self._push((priority, 0 if deadline is None else deadline, entry[0][2] if entry else next(self._counter)),
+                   content, (deadline, length))
+
+    def _get(self):
+        now = self.clock()
+        while self._queue:
+            _, _, content, (deadline, length) = self._pop()
+            if deadline is None or deadline >= now:
+                return content
+
+            self.dropped += 1
+            self.dropped_bytes += length
+
+        return None
+
+
+class PlaybackDeadlines:
+
+    # Playback deadline of each segment of a session: session start + (segment - 1) * segment duration + buffer.
+    # The session starts with the first request. When the client requests a segment whose deadline already passed (it
+    # stalled and rebuffered) the session start moves forward, so the request is not dropped on arrival
+
+    def __init__(self, segment_duration, buffer, clock=time.monotonic):
+        self.segment_duration = segment_duration
+        self.buffer = buffer
+        self.clock = clock
+        self.start = None
+
+    def deadline(self, segment, is_request=True):
+        now = self.clock()
+        if self.start is None:
+            self.start = now - (segment - 1) * self.segment_duration
+
+        deadline = self.start + (segment - 1) * self.segment_duration + self.buffer
+        if is_request and deadline < now:
+            self.start = now - (segment - 1) * self.segment_duration
+            deadline = now + self.buffer
+
+        return deadline
 
-        return index
 
-    def get_active_sum(self):
-        total_weight = 0
-        for i in range(self.n):
-            if self.active[i]:
-                total_weight += self.weight[i]
-
-        return total_weight
-
-    def update_virtual_time(self, packet_len):
-        total_weight = self.get_active_sum()
-        updated = False
-
-        while not updated and total_weight > 0:
-            min_f = self.get_active_min_f()
-            if min_f == -1:
-                exit()
-            idle_time = self.time - self.last_time
-            tmp = self.last_VT + idle_time*packet_len/total_weight
-
-            if self.FT[min_f][-1] <= tmp:
-                self.deactivate(min_f)
-                self.last_time = self.last_time + (self.FT[min_f][-1] - self.last_VT) * total_weight / packet_len
-                self.last_VT = self.FT[min_f][-1]
-                total_weight = self.get_active_sum()
-            else:
-                self.VT = tmp
-                self.last_time = self.VT
-                self.last_VT = self.time
-                updated = True
-
-    def deactivate(self, index):
-        self.active[index] = False
-
-    def activate(self, index):
-        self.active[index] = True
+def check_weights(weights):
+    weights = [float(weight) for weight in weights]
+    if not weights or any(weight <= 0 for weight in weights):
+        raise ValueError("WFQ weights must be a non-empty list of positive numbers")
+    return weights
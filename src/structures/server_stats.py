@@ -0,0 +1,44 @@
+class ServerStats:
+    # Counters of a server process. With several workers each one keeps its own and the parent process adds them up
+
+    def __init__(self):
+        self.connections = 0
+        self.open_connections = 0
+        self.requests = 0
+        self.tiles_sent = 0
+        self.tiles_pushed = 0
+        self.tiles_datagram = 0
+        self.bytes_sent = 0
+        self.tiles_dropped = 0
+        self.bytes_dropped = 0
+        self.tiles_superseded = 0
+        self.tiles_cancelled = 0
+        self.tiles_downgraded = 0
+
+    def get_stats(self):
+        return {
+            'connections': self.connections,
+            'open_connections': self.open_connections,
+            'requests': self.requests,
+            'tiles_sent': self.tiles_sent,
+            'tiles_pushed': self.tiles_pushed,
+            'tiles_datagram': self.tiles_datagram,
+            'bytes_sent': self.bytes_sent,
+            'tiles_dropped': self.tiles_dropped,
+            'bytes_dropped': self.bytes_dropped,
+            'tiles_superseded': self.tiles_superseded,
+            'tiles_cancelled': self.tiles_cancelled,
+            'tiles_downgraded': self.tiles_downgraded,
+        }
+
+
+def aggregate_stats(stats_list):
+    total = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def format_stats(stats):
+    return " ".join(key + "=" + str(value) for key, value in stats.items())
@@ -0,0 +1,57 @@
+import os
+import pickle
+from collections import OrderedDict
+
+
+class SessionTicketStore:
+    # Server side. Keeps the session tickets issued to the clients, by ticket id, so they can resume their sessions
+    # (and send 0-RTT data). A ticket is removed when it is used, so early data cannot be replayed with it. The oldest
+    # tickets are dropped beyond 'max_tickets'
+
+    def __init__(self, max_tickets=10000):
+        self.max_tickets = max_tickets
+        self.issued = 0
+        self.resumed = 0
+        self._tickets = OrderedDict()
+
+    def add(self, ticket):
+        self._tickets[ticket.ticket] = ticket
+        self.issued += 1
+        while len(self._tickets) > self.max_tickets:
+            self._tickets.popitem(last=False)
+
+    def pop(self, label):
+        ticket = self._tickets.pop(label, None)
+        if ticket is not None:
+            self.resumed += 1
+        return ticket
+
+
+class SessionTicketCache:
+    # Client side. The last session ticket received from each server, kept in a file so the next run can resume the
+    # session. Expired tickets are not returned
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._tickets = {}
+
+        if os.path.isfile(file_name):
+            try:
+                with open(file_name, "rb") as ticket_file:
+                    self._tickets = pickle.load(ticket_file)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                self._tickets = {}
+
+    def get(self, server):
+        ticket = self._tickets.get(server)
+        if ticket is None or not ticket.is_valid:
+            return None
+        return ticket
+
+    def put(self, server, ticket):
+        self._tickets[server] = ticket
+
+        temporary_name = self.file_name + ".tmp"
+        with open(temporary_name, "wb") as ticket_file:
+            pickle.dump(self._tickets, ticket_file)
+        os.replace(temporary_name, self.file_name)
@@ -0,0 +1,130 @@
+import os
+from collections import OrderedDict, defaultdict
+
+from src.constants.video_constants import LRU_POLICY, LFU_POLICY, FILE_FORMAT
+
+
+class TileCache:
+    # Server-wide cache of tile files, bounded by the total number of bytes it holds.
+    #
+    # With the LRU policy the least recently sent tile is evicted first. With the LFU policy tiles are kept in
+    # frequency buckets (each one ordered by recency), so eviction removes the least recently used tile among the
+    # least frequently sent ones in O(1)
+
+    def __init__(self, max_bytes, policy=LRU_POLICY):
+        if policy not in (LRU_POLICY, LFU_POLICY):
+            raise ValueError("Unknown cache policy: " + str(policy))
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._tiles = {}  # file name -> tile data
+        self._recency = OrderedDict()  # LRU order
+        self._frequency = {}  # file name -> number of hits
+        self._buckets = defaultdict(OrderedDict)  # number of hits -> file names, LFU order
+        self._min_frequency = 0
+
+    def get(self, file_name):
+        tile = self._tiles.get(file_name)
+
+        if tile is not None:
+            self.hits += 1
+            self._touch(file_name)
+            return tile
+
+        self.misses += 1
+        tile = self._read(file_name)
+        if tile is not None:
+            self.put(file_name, tile)
+
+        return tile
+
+    def put(self, file_name, tile):
+        length = len(tile)
+
+        if length > self.max_bytes or file_name in self._tiles:
+            return False
+
+        while self.size + length > self.max_bytes:
+            self._evict()
+
+        self._tiles[file_name] = tile
+        self.size += length
+
+        if self.policy == LRU_POLICY:
+            self._recency[file_name] = None
+        else:
+            self._frequency[file_name] = 1
+            self._buckets[1][file_name] = None
+            self._min_frequency = 1
+
+        return True
+
+    def preload(self, folder):
+        # Loads the folder's tiles until the byte budget is full. Returns the number of tiles loaded
+        loaded = 0
+
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith(FILE_FORMAT):
+                continue
+
+            file_name = os.path.join(folder, name)
+            if self.size + os.path.getsize(file_name) > self.max_bytes:
+                break
+
+            tile = self._read(file_name)
+            if tile is not None and self.put(file_name, tile):
+                loaded += 1
+
+        return loaded
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'tiles': len(self._tiles),
+            'bytes': self.size,
+        }
+
+    def _touch(self, file_name):
+        if self.policy == LRU_POLICY:
+            self._recency.move_to_end(file_name)
+            return
+
+        frequency = self._frequency[file_name]
+        bucket = self._buckets[frequency]
+        del bucket[file_name]
+        if not bucket:
+            del self._buckets[frequency]
+            if self._min_frequency == frequency:
+                self._min_frequency = frequency + 1
+
+        self._frequency[file_name] = frequency + 1
+        self._buckets[frequency + 1][file_name] = None
+
+    def _evict(self):
+        if self.policy == LRU_POLICY:
+            file_name, _ = self._recency.popitem(last=False)
+        else:
+            bucket = self._buckets[self._min_frequency]
+            file_name, _ = bucket.popitem(last=False)
+            if not bucket:
+                del self._buckets[self._min_frequency]
+                self._min_frequency = min(self._buckets) if self._buckets else 0
+            del self._frequency[file_name]
+
+        self.size -= len(self._tiles.pop(file_name))
+        self.evictions += 1
+
+    @staticmethod
+    def _read(file_name):
+        try:
+            with open(file_name, "rb") as video_file:
+                return video_file.read()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
@@ -0,0 +1,74 @@
+from src.structures.data_types import TILE_FRAGMENT_STRUCT, VideoPacket, check_wire_version
+
+
+class TileReassembler:
+    # Client side of the DATAGRAM delivery. Fragments are grouped by sequence number until the tile is complete. The
+    # stream notice of a tile (expect()) starts its timer too, so a tile whose fragments were all lost still expires.
+    # Tiles incomplete 'timeout' seconds after their first fragment or notice are dropped and counted as lost, they are
+    # never requested again.
+    #
+    # Sequences finished before their notice arrived are kept in '_finished' until it does, so it is ignored
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.tiles_completed = 0
+        self.tiles_lost = 0
+        self._partial = {}  # sequence -> [start time, VideoPacket, fragments, fragments received, notice received]
+        self._finished = set()
+
+    def expect(self, sequence, packet, now):
+        if sequence in self._finished:
+            self._finished.discard(sequence)
+            return
+
+        entry = self._partial.get(sequence)
+        if entry is None:
+            self._partial[sequence] = [now, packet, None, 0, True]
+        else:
+            entry[1] = packet
+            entry[4] = True
+
+    def add(self, datagram, now):
+        # Returns (VideoPacket, tile data, seconds since the first fragment or notice) when the tile is complete
+        version, sequence, index, count, segment, tile, bitrate = TILE_FRAGMENT_STRUCT.unpack_from(datagram)
+        check_wire_version(version)
+
+        if sequence in self._finished:
+            return None
+
+        entry = self._partial.get(sequence)
+        if entry is None:
+            entry = self._partial[sequence] = [now, VideoPacket(segment, tile, bitrate=bitrate), None, 0, False]
+        if entry[2] is None:
+            entry[2] = [None] * count
+
+        fragments = entry[2]
+        if index >= len(fragments) or fragments[index] is not None:
+            return None
+
+        fragments[index] = datagram[TILE_FRAGMENT_STRUCT.size:]
+        entry[3] += 1
+        if entry[3] < len(fragments):
+            return None
+
+        self._finish(sequence, entry)
+        self.tiles_completed += 1
+        return entry[1], b''.join(fragments), now - entry[0]
+
+    def expire(self, now):
+        # Returns the VideoPackets of the tiles that timed out
+        expired = [sequence for sequence, entry in self._partial.items() if now - entry[0] > self.timeout]
+
+        lost = []
+        for sequence in expired:
+            entry = self._partial[sequence]
+            self._finish(sequence, entry)
+            lost.append(entry[1])
+
+        self.tiles_lost += len(lost)
+        return lost
+
+    def _finish(self, sequence, entry):
+        del self._partial[sequence]
+        if not entry[4]:
+            self._finished.add(sequence)
@@ -0,0 +1,118 @@
+import mmap
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from src.constants.video_constants import MEMORY_STORAGE, ARENA_STORAGE, FILES_STORAGE, ARENA_SIZE, STORAGE_WORKERS
+from src.utils import get_client_file_name, get_client_folder, create_user_dir
+
+ARENA_FILE_NAME = 'tiles.arena'
+ARENA_INDEX_STRUCT = struct.Struct('<HHHQL')  # segment, tile, bitrate, offset, length
+
+
+class MemoryTileStorage:
+    # Where the client puts the tiles it receives. This one only counts them and drops the data, so the disk does not
+    # add to the measured download times. write() takes the chunks of a tile as they were read
+    mode = MEMORY_STORAGE
+
+    def __init__(self):
+        self.tiles = 0
+        self.bytes = 0
+
+    def write(self, segment, tile, bitrate, chunks):
+        self.tiles += 1
+        self.bytes += sum(len(chunk) for chunk in chunks)
+
+    def close(self):
+        pass
+
+
+class ArenaTileStorage(MemoryTileStorage):
+    # Every tile of the session in one file, preallocated and memory mapped, so storing a tile is a copy into the page
+    # cache instead of a new file. The file doubles when it is full. 'index' has the (offset, length) of the last copy
+    # of every (segment, tile, bitrate), and it is saved next to the file on close
+    mode = ARENA_STORAGE
+
+    def __init__(self, file_name, size):
+        super().__init__()
+        self.file_name = file_name
+        self.index = {}
+
+        self._file = open(file_name, "w+b")
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def write(self, segment, tile, bitrate, chunks):
+        offset = self.bytes
+        super().write(segment, tile, bitrate, chunks)
+        if self.bytes > len(self._map):
+            self._grow(self.bytes)
+
+        position = offset
+        for chunk in chunks:
+            self._map[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        self.index[(int(segment), int(tile), int(bitrate))] = (offset, self.bytes - offset)
+
+    def read(self, segment, tile, bitrate):
+        offset, length = self.index[(int(segment), int(tile), int(bitrate))]
+        return self._map[offset:offset + length]
+
+    def close(self):
+        self._map.close()
+        self._file.truncate(self.bytes)
+        self._file.close()
+
+        with open(self.file_name + ".idx", "wb") as index_file:
+            for (segment, tile, bitrate), (offset, length) in self.index.items():
+                index_file.write(ARENA_INDEX_STRUCT.pack(segment, tile, bitrate, offset, length))
+
+    def _grow(self, min_size):
+        size = max(len(self._map) * 2, min_size)
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+
+class FileTileStorage(MemoryTileStorage):
+    # One raw file per tile, at its client file name. The files are written by a thread pool, so the event loop never
+    # waits on the disk. close() waits for the pending writes
+    mode = FILES_STORAGE
+
+    def __init__(self, client_id, workers):
+        super().__init__()
+        self.client_id = client_id
+        self.errors = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tile-storage")
+
+    def write(self, segment, tile, bitrate, chunks):
+        super().write(segment, tile, bitrate, chunks)
+        file_name = get_client_file_name(segment=segment, tile=tile, bitrate=bitrate, client_id=self.client_id)
+        self._executor.submit(self._write_file, file_name, chunks).add_done_callback(self._written)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _write_file(file_name, chunks):
+        with open(file_name, "wb") as tile_file:
+            tile_file.writelines(chunks)
+
+    def _written(self, future):
+        if future.exception() is not None:
+            self.errors += 1
+
+
+def create_tile_storage(mode, client_id, arena_size=ARENA_SIZE, workers=STORAGE_WORKERS):
+    # The arena and files modes write under the client's folder, created here. 'arena_size' is in MB
+    if mode == MEMORY_STORAGE:
+        return MemoryTileStorage()
+
+    create_user_dir(client_id)
+    if mode == ARENA_STORAGE:
+        return ArenaTileStorage(os.path.join(get_client_folder(client_id), ARENA_FILE_NAME),
+                                int(arena_size * 1024 * 1024))
+    if mode == FILES_STORAGE:
+        return FileTileStorage(client_id, workers)
+
+    raise ValueError("Unknown tile storage: " + str(mode))
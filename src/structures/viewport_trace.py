@@ -0,0 +1,153 @@
+import csv
+import mmap
+import struct
+
+import numpy as np
+
+from src.constants.video_constants import MAX_TILE
+
+TRACE_MAGIC = b'TCTR'
+TRACE_VERSION = 1
+# magic, version, max tile, users, bytes of the user ids, frames, tiles
+TRACE_HEADER_STRUCT = struct.Struct('<4sHHIIQQ')
+
+
+class ViewportTrace:
+    # The tiles in the FOV of a user in every frame of the video, frames numbered from 1. The tile lists are stored
+    # back to back (CSR): the tiles of frame f are tiles[offsets[f - 1]:offsets[f]], in the order of the trace. In a
+    # TraceLibrary, 'tiles' has the tiles of every user and 'offsets' starts at the user's first one
+
+    def __init__(self, offsets, tiles, max_tile=MAX_TILE):
+        self.offsets = offsets
+        self.tiles = tiles
+        self.max_tile = max_tile
+        self.n_frames = len(offsets) - 1
+
+    def fov(self, frame):
+        return self.tiles[self.offsets[frame - 1]:self.offsets[frame]].tolist()
+
+    def fov_mask(self, skip_first=False):
+        # Frame x tile boolean matrix, row and column 0 unused. 'skip_first' leaves out the first tile of every frame.
+        # Tiles outside 0..max_tile are ignored
+        start = self.offsets[0]
+        counts = np.diff(self.offsets)
+        frames = np.repeat(np.arange(1, self.n_frames + 1), counts)
+        tiles = np.asarray(self.tiles[start:self.offsets[-1]], dtype=np.int64)
+
+        if skip_first:
+            keep = np.ones(len(tiles), dtype=bool)
+            keep[(self.offsets[:-1] - start)[counts > 0]] = False
+            frames, tiles = frames[keep], tiles[keep]
+
+        valid = (tiles >= 0) & (tiles <= self.max_tile)
+        mask = np.zeros((self.n_frames + 1, self.max_tile + 1), dtype=bool)
+        mask[frames[valid], tiles[valid]] = True
+        return mask
+
+
+def load_csv_trace(file_name, max_tile=MAX_TILE):
+    # The user input CSV: a header line, then a line per frame with the frame number and the tiles in the FOV
+    offsets = [0]
+    tiles = []
+
+    with open(file_name) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        next(csv_reader, None)
+        for row in csv_reader:
+            tiles.extend(int(tile) for tile in row[1:])
+            offsets.append(len(tiles))
+
+    return ViewportTrace(np.array(offsets, dtype=np.int64), np.array(tiles, dtype=np.int32), max_tile)
+
+
+class TraceLibrary:
+    # The traces of many users in one binary file, written by save_traces(). The file is memory mapped, so a trace is
+    # not parsed, only its pages are read when used, and processes reading the same file share them. After the header
+    # come the user ids ('\n' separated, padded to 8 bytes), the first frame of every user (int64, plus the end), the
+    # first tile of every frame (int64, plus the end) and the tiles (uint16)
+
+    def __init__(self, file_name):
+        with open(file_name, "rb") as trace_file:
+            self._map = mmap.mmap(trace_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < TRACE_HEADER_STRUCT.size:
+            raise ValueError(file_name + " is not a trace file")
+        magic, version, self.max_tile, n_users, names_size, n_frames, n_tiles = \
+            TRACE_HEADER_STRUCT.unpack_from(self._map)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError(file_name + " is not a version " + str(TRACE_VERSION) + " trace file")
+
+        offset = TRACE_HEADER_STRUCT.size
+        names = self._map[offset:offset + names_size].decode()
+        self.users = names.split("\n") if n_users else []
+        offset += _padded(names_size)
+
+        self._user_offsets = np.frombuffer(self._map, np.int64, n_users + 1, offset)
+        offset += self._user_offsets.nbytes
+        self._frame_offsets = np.frombuffer(self._map, np.int64, n_frames + 1, offset)
+        offset += self._frame_offsets.nbytes
+        self._tiles = np.frombuffer(self._map, np.uint16, n_tiles, offset)
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, user=None):
+        # The trace of 'user', or of the first user
+        if user is None and self.users:
+            index = 0
+        elif user in self.users:
+            index = self.users.index(user)
+        else:
+            raise ValueError("No trace for user " + str(user))
+
+        frames = self._frame_offsets[self._user_offsets[index]:self._user_offsets[index + 1] + 1]
+        return ViewportTrace(frames, self._tiles, self.max_tile)
+
+
+def save_traces(file_name, traces, max_tile=MAX_TILE):
+    # Writes {user id: ViewportTrace} as a TraceLibrary file, in the given order
+    names = "\n".join(traces).encode()
+    if any(not user or "\n" in user for user in traces):
+        raise ValueError("User ids cannot be empty or have line breaks")
+
+    user_offsets = [0]
+    frame_offsets = [np.zeros(1, dtype=np.int64)]
+    tiles = []
+    n_tiles = 0
+    for trace in traces.values():
+        trace_tiles = np.asarray(trace.tiles[trace.offsets[0]:trace.offsets[-1]])
+        if len(trace_tiles) and (trace_tiles.min() < 0 or trace_tiles.max() > np.iinfo(np.uint16).max):
+            raise ValueError("Tile ids must fit in 16 bits")
+
+        user_offsets.append(user_offsets[-1] + trace.n_frames)
+        frame_offsets.append(np.asarray(trace.offsets[1:], dtype=np.int64) - trace.offsets[0] + n_tiles)
+        tiles.append(trace_tiles.astype(np.uint16))
+        n_tiles += len(trace_tiles)
+
+    frame_offsets = np.concatenate(frame_offsets)
+    with open(file_name, "wb") as trace_file:
+        trace_file.write(TRACE_HEADER_STRUCT.pack(TRACE_MAGIC, TRACE_VERSION, max_tile, len(traces), len(names),
+                                                  len(frame_offsets) - 1, n_tiles))
+        trace_file.write(names + b'\0' * (_padded(len(names)) - len(names)))
+        np.array(user_offsets, dtype=np.int64).tofile(trace_file)
+        frame_offsets.tofile(trace_file)
+        for trace_tiles in tiles:
+            trace_tiles.tofile(trace_file)
+
+
+def is_trace_file(file_name):
+    with open(file_name, "rb") as trace_file:
+        return trace_file.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+
+
+def load_trace(file_name, user=None):
+    # A user's trace from a trace file, or from a CSV file, which only has one
+    if is_trace_file(file_name):
+        return TraceLibrary(file_name).get(user)
+    if user is not None:
+        raise ValueError(file_name + " is a CSV trace, it has no users")
+    return load_csv_trace(file_name)
+
+
+def _padded(size):
+    return (size + 7) // 8 * 8
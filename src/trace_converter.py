@@ -0,0 +1,52 @@
+import argparse
+import os
+
+from src.structures.viewport_trace import TraceLibrary, is_trace_file, load_csv_trace, save_traces
+
+
+def load_inputs(inputs):
+    # '[user id=]file' specs -> {user id: ViewportTrace}. The id of a CSV trace defaults to its file name, without the
+    # extension, and trace files add all of their users
+    traces = {}
+    for spec in inputs:
+        user, file_name = spec.split('=', 1) if '=' in spec and not os.path.exists(spec) else (None, spec)
+
+        if is_trace_file(file_name):
+            if user is not None:
+                raise ValueError(file_name + " is a trace file, its users keep their ids")
+            library = TraceLibrary(file_name)
+            user_traces = [(library_user, library.get(library_user)) for library_user in library.users]
+        else:
+            user_traces = [(user or os.path.splitext(os.path.basename(file_name))[0], load_csv_trace(file_name))]
+
+        for user_id, trace in user_traces:
+            if user_id in traces:
+                raise ValueError("User " + user_id + " is in more than one input")
+            traces[user_id] = trace
+
+    return traces
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts user input CSV traces into one memory mapped trace file")
+    parser.add_argument(
+        "output",
+        type=str,
+        help="trace file to write",
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        metavar="[USER_ID=]INPUT",
+        help="CSV traces, one user each (the id defaults to the file name), or trace files to merge",
+    )
+    args = parser.parse_args()
+
+    try:
+        traces = load_inputs(args.inputs)
+        save_traces(args.output, traces)
+    except (ValueError, OSError) as err:
+        parser.error(str(err))
+
+    print(str(len(traces)) + " traces, " + str(sum(trace.n_frames for trace in traces.values())) + " frames written to " +
+          args.output)
@@ -1,3 +1,4 @@
+import ast
 import os
 import time
 
@@ -18,6 +19,23 @@ def message_to_video_packet(data):
     return VideoPacket(segment=data[0], tile=data[1], priority=data[2], bitrate=data[3])
 
 
+def is_legacy_message(message_data):
+    return message_data[:1] == b'['
+
+
+def decode_quic_packet(message_data):
+    # Accepts both the binary and the legacy (str(list)) encodings while peers migrate
+    if is_legacy_message(message_data):
+        return message_to_quic_packet(ast.literal_eval(message_data.decode()))
+    return QUICPacket.deserialize(message_data)
+
+
+def decode_video_packet(message_data):
+    if is_legacy_message(message_data):
+        return message_to_video_packet(ast.literal_eval(message_data.decode()))
+    return VideoPacket.deserialize(message_data)
+
+
 def get_server_file_name(segment, tile, bitrate):
     return SERVER_FILE_LOCATION + FILE_BASE_NAME + str(int(bitrate)).strip() + FILE_END_NAME + str(tile).strip() + '_' + str(segment).strip() + FILE_FORMAT
 
@@ -37,10 +55,6 @@ def client_file_with_bitrate_exists(segment, tile, bitrate, client_id):
     return os.path.isfile(get_client_file_name(segment, tile, bitrate, client_id))
 
 
-def server_file_exists(file_name):
-    return os.path.isfile(file_name)
-
-
 def get_user_id():
     return str(int(time.time()))
 
@@ -0,0 +1,61 @@
+import argparse
+import timeit
+
+from src.structures.data_types import QUICPacket, VideoPacket
+from src.utils import message_to_quic_packet, decode_quic_packet, message_to_video_packet, decode_video_packet
+from src.constants.video_constants import HIGH_PRIORITY, BINARY_WIRE, LEGACY_WIRE
+
+CLIENT_ID = '1623456789'
+
+
+def eval_request(data):
+    # Request parsing as it was done before the binary wire format
+    return message_to_quic_packet(eval(data.decode()))
+
+
+def eval_response(data):
+    return message_to_video_packet(eval(data.decode()))
+
+
+def round_trip_requests(wire_format, decode, count):
+    for tile in range(count):
+        packet = QUICPacket(CLIENT_ID, False, VideoPacket(10, tile % 200 + 1, HIGH_PRIORITY, 10))
+        decode(packet.serialize(wire_format))
+
+
+def round_trip_responses(wire_format, decode, count):
+    for tile in range(count):
+        decode(VideoPacket(10, tile % 200 + 1, bitrate=10).serialize(wire_format))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Messages/s of the request and response encodings")
+    parser.add_argument(
+        "-n",
+        "--messages",
+        type=int,
+        default=100000,
+        help="number of messages encoded and decoded on each run (defaults to 100000)",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of runs, the best one is reported (defaults to 5)",
+    )
+    args = parser.parse_args()
+
+    n = args.messages
+    cases = [
+        ("request  legacy (eval)", lambda: round_trip_requests(LEGACY_WIRE, eval_request, n)),
+        ("request  legacy (literal_eval)", lambda: round_trip_requests(LEGACY_WIRE, decode_quic_packet, n)),
+        ("request  binary", lambda: round_trip_requests(BINARY_WIRE, decode_quic_packet, n)),
+        ("response legacy (eval)", lambda: round_trip_responses(LEGACY_WIRE, eval_response, n)),
+        ("response legacy (literal_eval)", lambda: round_trip_responses(LEGACY_WIRE, decode_video_packet, n)),
+        ("response binary", lambda: round_trip_responses(BINARY_WIRE, decode_video_packet, n)),
+    ]
+
+    for name, case in cases:
+        elapsed = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        print(name.ljust(32) + str(round(n / elapsed)) + " messages/s")
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import struct
+
+from src import server
+from src.constants.video_constants import BINARY_WIRE, SP_QUEUE, WFQ_QUEUE, WFQ_WEIGHTS, WFQ_TILE_SIZE, DATAGRAM_OFF, \
+    HIGH_PRIORITY, LOW_PRIORITY
+from src.structures.catalog import SegmentCatalog
+from src.structures.connection_state import ConnectionState
+from src.structures.data_types import QUICPacket, SegmentRequest
+from src.structures.event_logger import EventLogger
+from src.structures.push_state import PushState
+from src.structures.queues import PlaybackDeadlines
+from src.structures.server_stats import ServerStats
+
+HP_STREAM = 0
+LP_STREAM = 4
+
+
+class StreamWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += bytes(data)
+
+
+def configure_server(monkeypatch):
+    settings = {
+        'Queue_Type': SP_QUEUE, 'Server_Stats': ServerStats(), 'Metrics': None,
+        'Event_Log': EventLogger(level=logging.WARNING), 'Downgrade_Backlog': 0, 'Tile_Cache': None,
+        'Egress_Scheduler': None, 'Datagram_Mode': DATAGRAM_OFF, 'Live_Connections': {},
+    }
+    for name, value in settings.items():
+        monkeypatch.setattr(server, name, value, raising=False)
+
+
+def create_catalog(folder):
+    def file_name(segment, tile, bitrate):
+        return str(folder / (str(segment) + "_" + str(tile) + "_" + str(bitrate) + ".bin"))
+
+    catalog = SegmentCatalog(BINARY_WIRE, n_segments=1, max_tile=4, bitrates=[3], file_name=file_name)
+    for path in catalog.paths:
+        with open(path, "wb") as tile_file:
+            tile_file.write(b'tile')
+    catalog.scan()
+    return catalog
+
+
+def segment_request(tiles, fov_tiles):
+    data = QUICPacket('1', False, segment_request=SegmentRequest(1, 3, tiles, fov_tiles)).serialize(BINARY_WIRE)
+    return struct.pack('<L', len(data)) + data
+
+
+def serve(state, hp_data, lp_data, n_queued):
+    # Queues the requests of both streams, 'n_queued' entries in all, then sends until the queue is empty. Returns the
+    # data of each stream
+    async def run():
+        hp_writer, lp_writer = StreamWriter(), StreamWriter()
+        state.writers = {HP_STREAM: hp_writer, LP_STREAM: lp_writer}
+
+        hp_reader, lp_reader = asyncio.StreamReader(), asyncio.StreamReader()
+        hp_reader.feed_data(hp_data)
+        lp_reader.feed_data(lp_data)
+        receivers = [asyncio.ensure_future(server.receive(hp_reader, state, HP_STREAM)),
+                     asyncio.ensure_future(server.receive(lp_reader, state, LP_STREAM))]
+        while state.queue.qsize() < n_queued:
+            await asyncio.sleep(0)
+
+        sender = asyncio.ensure_future(server.send_tiles(None, state))
+        while not state.queue.empty():
+            await asyncio.sleep(0)
+        for task in receivers + [sender]:
+            task.cancel()
+
+        return hp_writer.data, lp_writer.data
+
+    return asyncio.new_event_loop().run_until_complete(run())
+
+
+def create_state(catalog):
+    return ConnectionState('1', '1', catalog, server.create_queue(),
+                           PushState(False, server.Event_Log, '1', catalog.n_segments, catalog.max_tile),
+                           PlaybackDeadlines(1, 1))
+
+
+def test_tile_requested_again_on_the_other_stream_is_sent_once(tmp_path, monkeypatch):
+    configure_server(monkeypatch)
+    catalog = create_catalog(tmp_path)
+    state = create_state(catalog)
+
+    # Tile 2 is in the FOV of the first request, on hp, and out of it in the second one, on lp
+    hp_data, lp_data = serve(state, segment_request([1, 2], [1, 2]), segment_request([2, 3, 4], []), 4)
+
+    header = bytes(catalog.header(catalog.index(segment=1, tile=2, bitrate=3)))
+    assert hp_data.count(header) == 0
+    assert lp_data.count(header) == 1
+    assert state.queue.superseded == 1
+    assert state.priority_bytes == {HIGH_PRIORITY: 4, LOW_PRIORITY: 12}
+
+
+def test_priorities_requested_on_different_streams_compete(tmp_path, monkeypatch):
+    configure_server(monkeypatch)
+    monkeypatch.setattr(server, 'Queue_Type', WFQ_QUEUE)
+    monkeypatch.setattr(server, 'WFQ_Weights', WFQ_WEIGHTS, raising=False)
+    monkeypatch.setattr(server, 'WFQ_Size', WFQ_TILE_SIZE, raising=False)
+    monkeypatch.setattr(server, 'WFQ_Queues', set(), raising=False)
+    state = create_state(create_catalog(tmp_path))
+
+    serve(state, segment_request([1, 2], [1, 2]), segment_request([3, 4], []), 4)
+
+    # The FOV tiles finish first and leave while the lp tiles are queued behind them
+    assert state.contended_bytes == {HIGH_PRIORITY: 8}